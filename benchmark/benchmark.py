@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+"""离线性能测试:用fixtures中保存的weibo.cn页面模拟一个用户,在本地HTTP服务器上完整爬取一遍,
+输出每秒页数、每秒微博数、每条微博的CPU时间、内存峰值和各类请求数"""
+
+import argparse
+import contextlib
+import importlib.util
+import json
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import threading
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from multiprocessing import Event, Process
+from socketserver import ThreadingMixIn
+from time import perf_counter, process_time, sleep
+
+import requests
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+BENCHMARK_DIR = os.path.split(os.path.realpath(__file__))[0]
+FIXTURE_DIR = BENCHMARK_DIR + os.sep + 'fixtures'
+SPIDER_PATH = os.path.dirname(BENCHMARK_DIR) + os.sep + 'weiboSpider.py'
+USER_ID = 1669879400
+PER_PAGE = 10  # 每个profile页面fixture中的微博数
+
+# (请求类别, 路径正则, fixture文件名);路径为去掉协议后的原始url,如/weibo.cn/comment/xx
+ROUTES = (
+    ('info', re.compile(r'^/weibo\.cn/\d+/info$'), 'info.html'),
+    ('profile', re.compile(r'^/weibo\.cn/\d+/profile(\?page=(\d+))?$'),
+     None),
+    ('long_weibo', re.compile(r'^/weibo\.cn/comment/(\w+)\?ckAll=1$'),
+     'long.html'),
+    ('long_weibo', re.compile(r'^/weibo\.cn/comment/(\w+)$'),
+     'long_retweet.html'),
+    ('pictures', re.compile(r'^/weibo\.cn/mblog/picAll/(\w+)\?rl=1$'),
+     'picall.html'),
+    ('video', re.compile(r'^/m\.weibo\.cn/s/video/object\?object_id=\w+%3A(\w+)$'),
+     'video.json'),
+    ('media', re.compile(r'^/[\w.]+\.(sinaimg\.cn|weibocdn\.com)/'), None),
+)
+
+
+def load_fixtures():
+    """读取全部fixture,profile页面按页码轮流使用"""
+    fixtures = {}
+    for name in os.listdir(FIXTURE_DIR):
+        with open(FIXTURE_DIR + os.sep + name, encoding='utf-8') as f:
+            fixtures[name] = f.read()
+    profiles = sorted(name for name in fixtures if name.startswith('profile_'))
+    return fixtures, [fixtures[name] for name in profiles]
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def make_handler(args):
+    """创建请求处理类,按url返回fixture并统计请求数"""
+    fixtures, profiles = load_fixtures()
+    first_day = datetime(2019, 12, 31)
+    stats = {}
+    lock = threading.Lock()
+    errors = random.Random(args.seed)
+
+    def render(text, page=1, weibo_id=''):
+        # 每页的微博id和日期不同,越靠后的页面越早
+        date = (first_day - timedelta(days=page)).strftime('%Y-%m-%d')
+        return (text.replace('{page}', '%04d' % page)
+                .replace('{page_num}', str(args.pages))
+                .replace('{weibo_num}', str(args.pages * PER_PAGE))
+                .replace('{date}', date)
+                .replace('{id}', weibo_id))
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def send(self, status, body, content_type='text/html; charset=utf-8'):
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def count(self, kind, status, size):
+            with lock:
+                key = '%s %d' % (kind, status)
+                stats[key] = stats.get(key, 0) + 1
+                stats['bytes'] = stats.get('bytes', 0) + size
+
+        def do_GET(self):
+            if self.path == '/__stats':
+                with lock:
+                    body = json.dumps(stats).encode('utf-8')
+                return self.send(200, body, 'application/json')
+            if args.latency:
+                sleep(args.latency)
+            for kind, pattern, fixture in ROUTES:
+                m = pattern.match(self.path)
+                if m:
+                    break
+            else:
+                self.count('other', 404, 0)
+                return self.send(404, b'')
+            if kind != 'media':
+                with lock:
+                    limited = errors.random() < args.error_rate
+                if limited:
+                    self.count(kind, 418, 0)
+                    return self.send(418, b'')
+            if kind == 'profile':
+                page = int(m.group(2) or 1)
+                if page > args.pages:
+                    page = 1  # 与weibo.cn相同,超出范围的页码返回第一页
+                body = render(profiles[(page - 1) % len(profiles)], page)
+            elif kind == 'media':
+                body = (self.path * (args.media_size // len(self.path) + 1)
+                        )[:args.media_size]
+            elif fixture == 'info.html':
+                body = render(fixtures[fixture])
+            else:
+                weibo_id = m.group(1)
+                page = re.search(r'Hb(\d{4})', weibo_id)
+                body = render(fixtures[fixture],
+                              int(page.group(1)) if page else 1, weibo_id)
+            body = body.encode('utf-8')
+            self.count(kind, 200, len(body))
+            self.send(200, body)
+
+    return Handler
+
+
+def serve(args, port, ready):
+    """在子进程中运行服务器,避免服务器占用的CPU时间计入爬虫"""
+    server = ThreadingHTTPServer(('127.0.0.1', port), make_handler(args))
+    ready.set()
+    server.serve_forever()
+
+
+class ReplaySession(object):
+    """将所有请求转发到本地服务器的HTTP会话,如https://weibo.cn/x转发为http://127.0.0.1:port/weibo.cn/x。
+    包装AsyncSession时get返回协程,其余方法直接使用AsyncSession的"""
+
+    def __init__(self, session, base_url):
+        self.session = session
+        self.base_url = base_url
+
+    def get(self, url, **kwargs):
+        return self.session.get(self.base_url + url.split('://', 1)[1],
+                                **kwargs)
+
+    def close(self):
+        self.session.close()
+
+    def __getattr__(self, name):
+        return getattr(self.session, name)
+
+
+def load_spider(work_dir):
+    """将weiboSpider.py复制到临时文件夹再导入,结果文件都写入该文件夹"""
+    path = work_dir + os.sep + 'weiboSpider.py'
+    shutil.copy(SPIDER_PATH, path)
+    spec = importlib.util.spec_from_file_location('weiboSpider', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def peak_rss():
+    """进程内存峰值(MB)"""
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':  # macOS单位为字节,Linux为KB
+        rss /= 1024
+    return round(rss / 1024.0, 1)
+
+
+def run(args):
+    """启动服务器并完整爬取一遍,返回测试结果"""
+    ready = Event()
+    server = Process(target=serve, args=(args, args.port, ready))
+    server.daemon = True
+    server.start()
+    ready.wait()
+    base_url = 'http://127.0.0.1:%d/' % args.port
+    work_dir = tempfile.mkdtemp(prefix='weibo_benchmark_')
+    try:
+        spider = load_spider(work_dir)
+        config = {
+            'pic_download': args.media,
+            'video_download': args.media,
+            'cookie': 'benchmark',
+            'rate_limit': args.rate_limit,
+            'download_rate_limit': args.rate_limit,
+        }
+        config.update(json.loads(args.config))
+        wb = spider.Weibo(
+            USER_ID,
+            config,
+            rate_limiter=spider.RateLimiter(args.rate_limit, args.backoff))
+        wb.session = ReplaySession(wb.session, base_url)
+        start_cpu, start_time = process_time(), perf_counter()
+        with open(os.devnull, 'w', encoding='utf-8') as devnull:
+            with contextlib.redirect_stdout(devnull):
+                wb.start()
+        seconds = perf_counter() - start_time
+        cpu = process_time() - start_cpu
+        wb.session.close()
+        stats = requests.get(base_url + '__stats').json()
+    finally:
+        server.terminate()
+        if args.keep:
+            print(u'结果文件保存在' + work_dir)
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    return {
+        'pages': args.pages,
+        'weibos': wb.got_num,
+        'seconds': round(seconds, 3),
+        'pages_per_second': round(args.pages / seconds, 2),
+        'weibos_per_second': round(wb.got_num / seconds, 2),
+        'cpu_seconds': round(cpu, 3),
+        'cpu_ms_per_weibo': round(cpu * 1000 / max(wb.got_num, 1), 3),
+        'peak_rss_mb': peak_rss(),
+        'bytes': stats.pop('bytes', 0),
+        'requests': stats,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=u'用本地fixtures离线测试weiboSpider的爬取性能')
+    parser.add_argument('--pages', type=int, default=50, help=u'模拟的微博页数')
+    parser.add_argument('--latency', type=float, default=0,
+                        help=u'服务器每个请求的延迟秒数')
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help=u'微博页面请求返回418的概率')
+    parser.add_argument('--backoff', type=float, default=0.1,
+                        help=u'被限制(418)后的基础等待秒数')
+    parser.add_argument('--rate-limit', type=float, default=1000,
+                        help=u'每秒最多请求数')
+    parser.add_argument('--media', type=int, choices=[0, 1], default=0,
+                        help=u'是否下载图片和视频')
+    parser.add_argument('--media-size', type=int, default=64 * 1024,
+                        help=u'每个图片/视频的字节数')
+    parser.add_argument('--config', default='{}',
+                        help=u'覆盖爬虫配置的json,如\'{"parse_workers": 4}\'')
+    parser.add_argument('--port', type=int, default=8964)
+    parser.add_argument('--seed', type=int, default=0, help=u'418注入的随机种子')
+    parser.add_argument('--keep', action='store_true', help=u'保留结果文件')
+    parser.add_argument('--output', help=u'将结果保存为json文件')
+    args = parser.parse_args()
+    result = run(args)
+    print(json.dumps(result, ensure_ascii=False, indent=4))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=4)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,55 @@
 {
   "cookie": "your cookie",
   "user_id": "weibo user_id you want to backup",
+  "user_id_list": [],
+  "user_workers": 2,
   "only_original": true,
   "pic_download": true,
   "video_download": true,
   "order": "time asc",
-  "debug": false
+  "debug": false,
+  "resume": 1,
+  "incremental": 0,
+  "since_date": "",
+  "until_date": "",
+  "start_page": 1,
+  "end_page": 0,
+  "pool_connections": 10,
+  "pool_maxsize": 10,
+  "keep_alive": 1,
+  "engine": "requests",
+  "download_workers": 1,
+  "download_host_limit": 4,
+  "download_chunk_size": 65536,
+  "rate_limit": 2,
+  "download_rate_limit": 20,
+  "max_retries": 10,
+  "timeout": 10,
+  "prefetch_pages": 2,
+  "parse_workers": 2,
+  "secondary_workers": 4,
+  "write_pages": 20,
+  "write_json": 0,
+  "json_compression": "none",
+  "json_flush_pages": 1,
+  "json_fsync": 0,
+  "write_sqlite": 0,
+  "sqlite_path": "",
+  "write_columnar": 0,
+  "cache": 0,
+  "cache_replay": 0,
+  "cache_dir": "",
+  "cache_size": 1024,
+  "cache_ttl": {
+    "long_weibo": -1,
+    "pictures": -1,
+    "video": 3600,
+    "info": 86400,
+    "profile": 3600
+  },
+  "media_store": 0,
+  "media_store_dir": "",
+  "download_existing": "skip",
+  "metrics": 0,
+  "metrics_textfile_dir": ""
 }
@@ -0,0 +1,81 @@
+# -*- coding: UTF-8 -*-
+"""PublishTimeParser和WeiboRecord发布时间格式化的单元测试"""
+
+import os
+import sys
+from datetime import datetime
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from weiboSpider import PublishTimeParser, WeiboRecord  # noqa: E402
+
+NOW = datetime(2020, 6, 15, 12, 30, 45)
+
+
+@pytest.fixture
+def parser():
+    return PublishTimeParser(NOW)
+
+
+def test_just_now(parser):
+    assert parser.parse_time(u'刚刚') == datetime(2020, 6, 15, 12, 30)
+
+
+def test_minutes_ago(parser):
+    assert parser.parse_time(u'5分钟前') == datetime(2020, 6, 15, 12, 25)
+    assert parser.parse_time(u'45分钟前') == datetime(2020, 6, 15, 11, 45)
+
+
+def test_today_with_nbsp(parser):
+    assert parser.parse(u'今天 08:05\xa0来自iPhone客户端') == (
+        datetime(2020, 6, 15, 8, 5), u'iPhone客户端')
+    assert parser.parse(u'今天 08:05\xa0') == (datetime(2020, 6, 15, 8, 5),
+                                                u'无')
+
+
+def test_yesterday(parser):
+    assert parser.parse_time(u'昨天 23:59') == datetime(2020, 6, 14, 23, 59)
+
+
+def test_month_day(parser):
+    assert parser.parse_time(u'03月02日 07:08') == datetime(2020, 3, 2, 7, 8)
+
+
+def test_month_day_year_rollover():
+    # 参考时间为1月1日时,12月31日的微博属于上一年
+    parser = PublishTimeParser(datetime(2020, 1, 1, 0, 5, 33))
+    assert parser.parse_time(u'12月31日 23:50') == datetime(
+        2019, 12, 31, 23, 50)
+    assert parser.parse_time(u'01月01日 00:01') == datetime(2020, 1, 1, 0, 1)
+
+
+def test_full_date(parser):
+    assert parser.parse_time(u'2018-11-03 21:07:59') == datetime(
+        2018, 11, 3, 21, 7)
+    assert parser.parse(u'2018-11-03 21:07:59\xa0来自微博 weibo.com') == (
+        datetime(2018, 11, 3, 21, 7), u'微博 weibo.com')
+
+
+def test_tool_split(parser):
+    assert parser.parse(u'刚刚 来自Android') == (datetime(2020, 6, 15, 12, 30),
+                                               u'Android')
+    assert parser.parse(u'刚刚') == (datetime(2020, 6, 15, 12, 30), u'无')
+
+
+def test_unparseable(parser):
+    with pytest.raises(ValueError):
+        parser.parse_time(u'很久以前')
+
+
+def test_record_time_text():
+    w = WeiboRecord()
+    assert w.publish_time_text == ''
+    assert w.to_dict()['publish_time'] == ''
+    w.publish_time = datetime(2019, 12, 10, 9, 3)
+    assert w.publish_time_text == '2019-12-10 09:03'
+    assert w.to_dict()['publish_time'] == '2019-12-10 09:03'
+    assert '_publish_time_text' not in w.to_dict()
+    w.publish_time = datetime(2019, 12, 11, 10, 4)
+    assert w.publish_time_text == '2019-12-11 10:04'
@@ -1,28 +1,876 @@
     #!/usr/bin/env python
 # -*- coding: UTF-8 -*-
 
+import asyncio
 import codecs
 import csv
+import functools
+import gzip
+import hashlib
 import json
 import os
 import random
 import re
+import shutil
+import sqlite3
 import sys
+import threading
 import traceback
-from collections import OrderedDict
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import closing
 from datetime import datetime, timedelta
-from time import sleep
+from email.utils import formatdate, mktime_tz, parsedate_tz
+from time import perf_counter, sleep, time
+
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
 
 import requests
 from lxml import etree
 from requests.adapters import HTTPAdapter
 from tqdm import tqdm
 
+try:
+    import aiohttp
+    import yarl
+except ImportError:
+    aiohttp = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+except ImportError:
+    pyarrow = None
+
+try:
+    import pyarrow.parquet
+    parquet = pyarrow.parquet
+except ImportError:
+    parquet = None
+
+
+class RateLimiter(object):
+    """令牌桶限速器,按AIMD方式调整速率:请求正常时线性加速,被限制时减半并退避"""
+
+    def __init__(self, max_rate, backoff=10, max_backoff=300):
+        self.max_rate = max_rate  # 每秒最多请求数
+        self.min_rate = max_rate / 40.0
+        self.rate = max_rate  # 当前每秒允许的请求数
+        self.increase = max_rate / 40.0  # 每次请求正常时增加的速率
+        self.backoff = backoff  # 第一次被限制时的基础等待秒数
+        self.max_backoff = max_backoff
+        self.tokens = 1.0
+        self.updated = time()
+        self.blocked_until = 0  # 被限制后,在此时间之前暂停所有请求
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """尝试获取一个令牌,成功时返回0,令牌不足或处于退避期时返回需要等待的秒数"""
+        with self.lock:
+            now = time()
+            if now < self.blocked_until:
+                return self.blocked_until - now
+            self.tokens = min(max(1.0, self.rate),
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        """获取一个令牌,令牌不足或处于退避期时等待"""
+        wait_time = self.reserve()
+        while wait_time:
+            sleep(wait_time)
+            wait_time = self.reserve()
+
+    async def async_acquire(self):
+        """acquire的协程版本,等待时不占用线程,与acquire共用同一个令牌桶"""
+        wait_time = self.reserve()
+        while wait_time:
+            await asyncio.sleep(wait_time)
+            wait_time = self.reserve()
+
+    def on_success(self):
+        """请求正常,线性提高速率"""
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def on_limited(self, attempt):
+        """请求被限制,速率减半,并按重试次数指数退避(带随机抖动),返回等待秒数"""
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            wait_time = min(self.max_backoff, self.backoff * 2**attempt)
+            wait_time *= random.uniform(0.5, 1.5)
+            self.blocked_until = max(self.blocked_until, time() + wait_time)
+            self.tokens = 0.0
+            return wait_time
+
+
+class BufferedResponse(object):
+    """已完整读取到内存中的HTTP响应,提供与requests.Response相同的常用属性和方法"""
+
+    def __init__(self, url, status_code, headers, content, history=()):
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self.history = history  # 重定向前的响应,未重定向时为空
+
+    def json(self):
+        return json.loads(self.content.decode('utf-8'))
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(u'%d Error: %s' %
+                                     (self.status_code, self.url))
+
+    def iter_content(self, chunk_size=1):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i:i + chunk_size]
+
+    def close(self):
+        pass
+
+
+class ResponseCache(object):
+    """微博页面响应的磁盘缓存,以url为键,按url类别设置有效期,
+    总大小超过上限时删除最久未使用的响应。replay为True时只读取缓存,不访问网络"""
+    # url类别及默认有效期(秒),0表示不缓存,-1表示永不过期
+    DEFAULT_TTL = OrderedDict([
+        ('long_weibo', -1),  # 长微博全文(comment/<id>?ckAll=1)
+        ('pictures', -1),  # 组图(mblog/picAll/<id>)
+        ('video', 3600),  # 视频信息json,其中的视频地址会过期
+        ('info', 86400),  # 用户资料页
+        ('profile', 3600),  # 微博列表页
+    ])
+    URL_PATTERNS = [
+        ('long_weibo', re.compile(r'/comment/\w+')),
+        ('pictures', re.compile(r'/mblog/picAll/')),
+        ('video', re.compile(r'/s/video/object')),
+        ('info', re.compile(r'/\d+/info$')),
+        ('profile', re.compile(r'/profile')),
+    ]
+
+    def __init__(self, cache_dir, ttl, max_size, replay=False):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_size = max_size  # 缓存总大小上限(字节)
+        self.replay = replay
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # 缓存文件的键和大小,按最近使用时间排序
+        self.size = 0
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        files = []
+        for root, _, names in os.walk(cache_dir):
+            for name in names:
+                if not name.endswith('.tmp'):
+                    stat = os.stat(os.path.join(root, name))
+                    files.append((stat.st_atime, name, stat.st_size))
+        for _, key, size in sorted(files):
+            self.entries[key] = size
+            self.size += size
+
+    @classmethod
+    def get_url_class(cls, url):
+        """获取url所属类别,不属于任何类别时返回None"""
+        for url_class, pattern in cls.URL_PATTERNS:
+            if pattern.search(url):
+                return url_class
+
+    def get_ttl(self, url):
+        """获取url所属类别的有效期"""
+        return self.ttl.get(self.get_url_class(url), 0)
+
+    def get_path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def get(self, url):
+        """读取url的缓存内容,没有缓存或已过期时返回None"""
+        ttl = self.get_ttl(url)
+        if not ttl and not self.replay:
+            return None
+        key = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        path = self.get_path(key)
+        try:
+            # 文件的修改时间为写入缓存的时间,访问时间为最近使用的时间
+            mtime = os.stat(path).st_mtime
+            if not self.replay and ttl > 0 and time() - mtime > ttl:
+                return None
+            with open(path, 'rb') as f:
+                content = f.read()
+            os.utime(path, (time(), mtime))
+        except (IOError, OSError):
+            return None
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+        return content
+
+    def set(self, url, content):
+        """缓存url的响应内容"""
+        if not self.get_ttl(url) or self.replay:
+            return
+        key = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        path = self.get_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = '%s.%d.tmp' % (path, threading.current_thread().ident)
+        with open(temp_path, 'wb') as f:
+            f.write(content)
+        os.replace(temp_path, path)
+        with self.lock:
+            self.size += len(content) - self.entries.pop(key, 0)
+            self.entries[key] = len(content)
+            while self.size > self.max_size and len(self.entries) > 1:
+                old_key, old_size = self.entries.popitem(last=False)
+                self.size -= old_size
+                try:
+                    os.remove(self.get_path(old_key))
+                except OSError:
+                    pass
+
+
+class Metrics(object):
+    """爬取过程的性能指标:各阶段的耗时直方图、按url类别和状态码统计的请求数、
+    下载的字节数和被限制后退避等待的时间"""
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30,
+               60)  # 直方图各桶的上限(秒)
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.start_time = time()
+        self.lock = threading.Lock()
+        self.stages = OrderedDict()  # 阶段: [各桶的次数, 总耗时, 最大耗时]
+        self.requests = {}  # (url类别, 状态码): 请求次数,读取缓存时状态码为cached
+        self.bytes = {}  # url类别: 字节数
+        self.backoff_seconds = 0.0
+
+    def observe(self, stage, seconds):
+        """记录一次stage阶段的耗时"""
+        with self.lock:
+            if stage not in self.stages:
+                self.stages[stage] = [[0] * (len(self.BUCKETS) + 1), 0.0, 0.0]
+            histogram = self.stages[stage]
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    break
+            else:
+                i = len(self.BUCKETS)
+            histogram[0][i] += 1
+            histogram[1] += seconds
+            histogram[2] = max(histogram[2], seconds)
+
+    def add_request(self, url_class, status):
+        with self.lock:
+            key = (url_class, str(status))
+            self.requests[key] = self.requests.get(key, 0) + 1
+
+    def add_bytes(self, url_class, size):
+        with self.lock:
+            self.bytes[url_class] = self.bytes.get(url_class, 0) + size
+
+    def add_backoff(self, seconds):
+        with self.lock:
+            self.backoff_seconds += seconds
+
+    def get_summary(self):
+        """获取全部指标,直方图各桶的次数为累计值(耗时不超过该上限的次数)"""
+        with self.lock:
+            summary = OrderedDict()
+            summary['user_id'] = self.user_id
+            summary['seconds'] = round(time() - self.start_time, 3)
+            summary['stages'] = OrderedDict()
+            for stage, (counts, total, longest) in self.stages.items():
+                count = sum(counts)
+                buckets = OrderedDict()
+                cumulative = 0
+                for bound, bucket_count in zip(self.BUCKETS + ('+Inf', ),
+                                               counts):
+                    cumulative += bucket_count
+                    buckets[str(bound)] = cumulative
+                summary['stages'][stage] = OrderedDict([
+                    ('count', count), ('seconds', round(total, 3)),
+                    ('mean_ms', round(total * 1000 / count, 3)),
+                    ('max_ms', round(longest * 1000, 3)),
+                    ('buckets', buckets)
+                ])
+            summary['requests'] = OrderedDict()
+            for (url_class, status), count in sorted(self.requests.items()):
+                summary['requests'].setdefault(url_class,
+                                               OrderedDict())[status] = count
+            summary['bytes'] = OrderedDict(sorted(self.bytes.items()))
+            summary['backoff_seconds'] = round(self.backoff_seconds, 3)
+            return summary
+
+    def write_json(self, file_path):
+        with open(file_path, 'w', encoding='utf-8') as f:
+            json.dump(self.get_summary(), f, ensure_ascii=False, indent=4)
+
+    def write_prometheus(self, file_path):
+        """写入Prometheus的textfile格式,先写临时文件再重命名,采集时不会读到写了一半的文件"""
+        summary = self.get_summary()
+        user = 'user_id="%d"' % self.user_id
+        lines = [
+            '# HELP weibo_spider_stage_seconds Time spent in each crawl stage.',
+            '# TYPE weibo_spider_stage_seconds histogram'
+        ]
+        for stage, values in summary['stages'].items():
+            labels = '%s,stage="%s"' % (user, stage)
+            for bound, count in values['buckets'].items():
+                lines.append('weibo_spider_stage_seconds_bucket{%s,le="%s"} %d'
+                             % (labels, bound, count))
+            lines.append('weibo_spider_stage_seconds_sum{%s} %s' %
+                         (labels, values['seconds']))
+            lines.append('weibo_spider_stage_seconds_count{%s} %d' %
+                         (labels, values['count']))
+        lines.append('# HELP weibo_spider_requests_total HTTP requests by url '
+                     'class and status.')
+        lines.append('# TYPE weibo_spider_requests_total counter')
+        for url_class, statuses in summary['requests'].items():
+            for status, count in statuses.items():
+                lines.append(
+                    'weibo_spider_requests_total{%s,url_class="%s",status="%s"}'
+                    ' %d' % (user, url_class, status, count))
+        lines.append('# HELP weibo_spider_bytes_total Bytes received by url '
+                     'class.')
+        lines.append('# TYPE weibo_spider_bytes_total counter')
+        for url_class, size in summary['bytes'].items():
+            lines.append('weibo_spider_bytes_total{%s,url_class="%s"} %d' %
+                         (user, url_class, size))
+        lines.append('# HELP weibo_spider_backoff_seconds_total Time spent '
+                     'waiting after being rate limited.')
+        lines.append('# TYPE weibo_spider_backoff_seconds_total counter')
+        lines.append('weibo_spider_backoff_seconds_total{%s} %s' %
+                     (user, summary['backoff_seconds']))
+        temp_path = file_path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(temp_path, file_path)
+
+
+def timed(stage):
+    """记录方法耗时的装饰器,Weibo实例未开启性能指标时不做任何记录,也可用于协程方法"""
+
+    def decorator(method):
+        if asyncio.iscoroutinefunction(method):
+
+            @functools.wraps(method)
+            async def async_wrapper(self, *args, **kwargs):
+                if self.metrics is None:
+                    return await method(self, *args, **kwargs)
+                start_time = perf_counter()
+                try:
+                    return await method(self, *args, **kwargs)
+                finally:
+                    self.metrics.observe(stage, perf_counter() - start_time)
+
+            return async_wrapper
+
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if self.metrics is None:
+                return method(self, *args, **kwargs)
+            start_time = perf_counter()
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                self.metrics.observe(stage, perf_counter() - start_time)
+
+        return wrapper
+
+    return decorator
+
+
+class MediaStore(object):
+    """按内容寻址的图片/视频存储,可被多个用户共享。每个文件只在store_dir中保存一份,
+    以内容的sha256命名,同时按url建立索引;各用户文件夹中的文件是指向它的硬链接"""
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self.lock = threading.Lock()
+
+    def get_url_path(self, url):
+        """获取url索引文件的路径,新浪图片url只保留尺寸和文件名,视频url去掉会过期的查询参数"""
+        parsed = urlparse(url)
+        if parsed.netloc.endswith('sinaimg.cn'):
+            url_key = 'sinaimg/' + '/'.join(parsed.path.split('/')[-2:])
+        else:
+            url_key = parsed.netloc + parsed.path
+        key = hashlib.sha1(url_key.encode('utf-8')).hexdigest()
+        return os.path.join(self.store_dir, 'url', key[:2], key)
+
+    def get_blob_path(self, digest):
+        """获取内容为digest的文件的路径"""
+        return os.path.join(self.store_dir, 'sha256', digest[:2], digest)
+
+    def link(self, src, dst):
+        """将dst指向src,不支持硬链接时复制文件"""
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        temp_path = '%s.%d.link' % (dst, threading.current_thread().ident)
+        try:
+            os.link(src, temp_path)
+        except OSError:
+            shutil.copyfile(src, temp_path)
+        os.replace(temp_path, dst)
+
+    def get(self, url, file_path):
+        """url已在存储中时将其链接到file_path并返回True,否则返回False"""
+        url_path = self.get_url_path(url)
+        if not os.path.isfile(url_path):
+            return False
+        self.link(url_path, file_path)
+        return True
+
+    def add(self, url, temp_path, digest, file_path):
+        """将下载完成的temp_path存入存储(内容已存在时直接复用),并链接到file_path"""
+        blob_path = self.get_blob_path(digest)
+        with self.lock:
+            if os.path.isfile(blob_path):
+                os.remove(temp_path)
+            else:
+                os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+                os.replace(temp_path, blob_path)
+        self.link(blob_path, self.get_url_path(url))
+        self.link(blob_path, file_path)
+
+
+class AsyncStreamResponse(BufferedResponse):
+    """aiohttp的流式响应,iter_content为异步生成器,关闭时释放连接和AsyncSession的并发名额"""
+
+    def __init__(self, response, semaphore):
+        super(AsyncStreamResponse, self).__init__(str(response.url),
+                                                  response.status,
+                                                  response.headers, None,
+                                                  response.history)
+        self.response = response
+        self.semaphore = semaphore
+
+    async def iter_content(self, chunk_size=1):
+        async for chunk in self.response.content.iter_chunked(chunk_size):
+            yield chunk
+
+    def close(self):
+        if self.response is not None:
+            self.response.release()
+            self.semaphore.release()
+            self.response = None
+
+
+class AsyncSession(object):
+    """基于asyncio和aiohttp的异步引擎,可被多个Weibo实例共享。所有请求都是同一个后台事件循环中的
+    协程,同时进行的请求数由信号量限制,等待网络、限速和退避时不占用线程;解析页面和读写图片/视频
+    文件在工作线程池中执行。每个用户只有一个线程,负责调度和写入结果文件"""
+
+    def __init__(self, limit_per_host, limit, keep_alive, workers):
+        if aiohttp is None:
+            sys.exit(u'使用asyncio引擎需要先安装aiohttp: pip install aiohttp')
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.client, self.semaphore = self.run(
+            self.create_client(limit_per_host, limit, keep_alive))
+
+    async def create_client(self, limit_per_host, limit, keep_alive):
+        connector = aiohttp.TCPConnector(limit=limit,
+                                         limit_per_host=limit_per_host,
+                                         force_close=not keep_alive)
+        # 信号量在事件循环中创建,限制包括流式下载在内的同时进行的请求数
+        return aiohttp.ClientSession(
+            connector=connector), asyncio.Semaphore(limit)
+
+    def run(self, coroutine):
+        """在事件循环中执行协程,并在当前线程等待其结果,不能在事件循环所在的线程中调用"""
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def submit(self, function, *args):
+        """与Executor.submit相同,function为协程函数,返回concurrent.futures.Future"""
+        return asyncio.run_coroutine_threadsafe(function(*args), self.loop)
+
+    def create_task(self, coroutine):
+        """在事件循环中开始执行协程,返回的Task可用wait_task等待或cancel_tasks取消"""
+
+        async def create():
+            return asyncio.ensure_future(coroutine)
+
+        return self.run(create())
+
+    def wait_task(self, task):
+        """在当前线程等待task的结果"""
+
+        async def wait():
+            return await task
+
+        return self.run(wait())
+
+    def cancel_tasks(self, tasks):
+        """取消tasks,并等待它们结束,包括已在工作线程池中开始执行的部分"""
+
+        async def cancel():
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        self.run(cancel())
+
+    async def run_in_executor(self, function, *args):
+        """在工作线程池中执行function。协程被取消时仍等待已开始的function执行完毕,
+        取消后不会再有解析或文件读写在后台进行"""
+        future = self.loop.run_in_executor(self.executor, function, *args)
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            await asyncio.wait([future])
+            raise
+
+    async def get(self, url, cookies=None, timeout=None, stream=False,
+                  headers=None):
+        """发送GET请求的协程,参数与requests.Session.get相同。stream为False时返回
+        BufferedResponse,为True时返回AsyncStreamResponse,读取完毕后需调用close"""
+        headers = dict(headers or {})
+        if cookies:
+            # 与requests相同,将cookies字典转换为Cookie请求头
+            headers['Cookie'] = '; '.join('%s=%s' % (key, value)
+                                          for key, value in cookies.items())
+        client_timeout = aiohttp.ClientTimeout(sock_connect=timeout,
+                                               sock_read=timeout)
+        await self.semaphore.acquire()
+        try:
+            # url已经过编码,如视频接口的object_id=1034%3Axxx,不能让aiohttp再次规范化
+            response = await self.client.get(yarl.URL(url, encoded=True),
+                                             headers=headers,
+                                             timeout=client_timeout)
+        except BaseException:
+            self.semaphore.release()
+            raise
+        if stream:
+            return AsyncStreamResponse(response, self.semaphore)
+        try:
+            content = await response.read()
+        finally:
+            response.release()
+            self.semaphore.release()
+        return BufferedResponse(str(response.url), response.status,
+                                response.headers, content, response.history)
+
+    def close(self):
+        self.run(self.client.close())
+        self.executor.shutdown()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+
+XPATH_WEIBO = etree.XPath("//div[@class='c']")
+XPATH_CTT = etree.XPath("div/span[@class='ctt']")
+XPATH_DIV = etree.XPath('div')
+XPATH_CMT = etree.XPath("div/span[@class='cmt']")
+XPATH_CT = etree.XPath("div/span[@class='ct']")
+XPATH_DIV_A_TEXT = etree.XPath('div//a/text()')
+XPATH_DIV_A_HREF = etree.XPath('div/a/@href')
+XPATH_CC_HREF = etree.XPath("div/a[@class='cc']/@href")
+XPATH_IMG_SRC = etree.XPath('.//img/@src')
+XPATH_TEXT = etree.XPath('text()')
+XPATH_A = etree.XPath('a')
+XPATH_A_HREF = etree.XPath('a/@href')
+XPATH_ALL_A = etree.XPath('.//a')
+XPATH_CTT_A = etree.XPath("span[@class='ctt']/a")
+XPATH_STRING = etree.XPath('string(.)')
+
+
+def normalize_text(element):
+    """获取节点的全部文本并去掉零宽空格,结果与终端编码无关"""
+    return XPATH_STRING(element).replace(u'\u200b', u'')
+
+
+class PublishTimeParser(object):
+    """解析微博的发布时间和发布工具。相对时间(刚刚、几分钟前、今天、几月几日)都以
+    同一个参考时间now为准,跨越零点的爬取中各微博的日期和年份保持一致"""
+    JUST_NOW = re.compile(r'刚刚')
+    MINUTES_AGO = re.compile(r'(\d+)分钟')
+    TODAY = re.compile(r'今天\s*(\d{1,2}):(\d{2})')
+    YESTERDAY = re.compile(r'昨天\s*(\d{1,2}):(\d{2})')
+    THIS_YEAR = re.compile(r'(\d{1,2})月(\d{1,2})日\s*(\d{1,2}):(\d{2})')
+    FULL_DATE = re.compile(r'(\d{4})-(\d{1,2})-(\d{1,2})\s+(\d{1,2}):(\d{2})')
+
+    def __init__(self, now):
+        self.now = now.replace(second=0, microsecond=0)
+
+    def parse_time(self, publish_time):
+        """将发布时间文本转为datetime"""
+        m = self.FULL_DATE.match(publish_time)
+        if m:
+            return datetime(*[int(group) for group in m.groups()])
+        m = self.THIS_YEAR.match(publish_time)
+        if m:
+            month, day, hour, minute = [int(group) for group in m.groups()]
+            result = self.now.replace(month=month,
+                                      day=day,
+                                      hour=hour,
+                                      minute=minute)
+            if result > self.now + timedelta(days=1):
+                # 只显示月日的是今年的微博,晚于当前时间说明参考时间已到了下一年
+                result = result.replace(year=result.year - 1)
+            return result
+        m = self.TODAY.match(publish_time)
+        if m:
+            return self.now.replace(hour=int(m.group(1)),
+                                    minute=int(m.group(2)))
+        m = self.YESTERDAY.match(publish_time)
+        if m:
+            return (self.now - timedelta(days=1)).replace(
+                hour=int(m.group(1)), minute=int(m.group(2)))
+        m = self.MINUTES_AGO.match(publish_time)
+        if m:
+            return self.now - timedelta(minutes=int(m.group(1)))
+        if self.JUST_NOW.match(publish_time):
+            return self.now
+        raise ValueError(u'无法解析的发布时间: ' + publish_time)
+
+    def parse(self, str_time):
+        """将span.ct的文本解析为(发布时间, 发布工具),没有发布工具时为'无'"""
+        publish_time, separator, publish_tool = str_time.partition(u'来自')
+        return (self.parse_time(publish_time.strip()),
+                publish_tool if separator else u'无')
+
+
+class WeiboNode(object):
+    """一条微博(div.c)的节点和字符串,每项只计算一次,供各字段的解析方法共用"""
+    __slots__ = ('info', 'id', 'divs', 'cmt', '_text', '_last_div_text',
+                 '_time_text', 'publish_info')
+
+    def __init__(self, info):
+        self.info = info
+        self.id = info.get('id')[2:]
+        self.divs = XPATH_DIV(info)
+        self.cmt = XPATH_CMT(info)
+        self.publish_info = None  # (发布时间, 发布工具),由PublishTimeParser解析
+        self._text = None
+        self._last_div_text = None
+        self._time_text = None
+
+    @property
+    def text(self):
+        """整条微博的文本"""
+        if self._text is None:
+            self._text = normalize_text(self.info)
+        return self._text
+
+    @property
+    def last_div_text(self):
+        """最后一个div(转发理由和点赞数等)的文本"""
+        if self._last_div_text is None:
+            if (len(self.info) == 1 and not self.info.text
+                    and not self.divs[-1].tail):
+                # 只有一个div时(多数原创微博),其文本就是整条微博的文本
+                self._last_div_text = self.text
+            else:
+                self._last_div_text = normalize_text(self.divs[-1])
+        return self._last_div_text
+
+    @property
+    def time_text(self):
+        """发布时间和发布工具的文本"""
+        if self._time_text is None:
+            self._time_text = normalize_text(XPATH_CT(self.info)[0])
+        return self._time_text
+
+
+class WeiboRecord(object):
+    """一条微博的爬取结果,字段固定,图片url为列表,发布时间为datetime"""
+    FIELDS = ('id', 'url', 'overview', 'is_original', 'original_user',
+              'retweet_reason', 'content', 'original_pictures',
+              'retweet_pictures', 'video_url', 'publish_place',
+              'publish_time', 'publish_tool', 'up_num', 'retweet_num',
+              'comment_num')
+    __slots__ = FIELDS + ('_publish_time_text', )
+
+    def __init__(self):
+        for key in self.__slots__:
+            setattr(self, key, None)
+
+    def __getitem__(self, key):
+        """兼容按字典方式读取字段,如weibo['id']"""
+        return getattr(self, key)
+
+    def to_dict(self):
+        """转为可序列化为json的字典,发布时间的格式与结果文件中相同"""
+        result = OrderedDict((key, getattr(self, key)) for key in self.FIELDS)
+        result['publish_time'] = self.publish_time_text
+        return result
+
+    @property
+    def publish_time_text(self):
+        """结果文件中的发布时间,各输出共用,发布时间不变时只格式化一次"""
+        cached = self._publish_time_text
+        if cached is None or cached[0] is not self.publish_time:
+            cached = (self.publish_time, self.format_time(self.publish_time))
+            self._publish_time_text = cached
+        return cached[1]
+
+    @staticmethod
+    def format_pictures(pictures):
+        """将图片url列表转为结果文件中以英文逗号分隔的形式,没有图片时为'无'"""
+        return ','.join(pictures) if pictures else u'无'
+
+    @staticmethod
+    def format_time(publish_time):
+        """将发布时间转为结果文件中的形式,没有发布时间时为空字符串"""
+        if publish_time is None:
+            return ''
+        return publish_time.strftime('%Y-%m-%d %H:%M')
+
+
+# csv文件的列:(表头, 是否只在爬取全部微博时存在, 取值函数)
+CSV_COLUMNS = (
+    (u'微博地址', False, lambda w: w.url),
+    (u'是否为原创微博', True, lambda w: w.is_original),
+    (u'转发内容', True, lambda w: w.retweet_reason),
+    (u'原作者', True, lambda w: w.original_user),
+    (u'微博正文', False, lambda w: w.content),
+    (u'原始图片url', False,
+     lambda w: WeiboRecord.format_pictures(w.original_pictures)),
+    (u'被转发微博原始图片地址', True,
+     lambda w: WeiboRecord.format_pictures(w.retweet_pictures)),
+    (u'微博视频地址', False, lambda w: w.video_url),
+    (u'发布位置', False, lambda w: w.publish_place),
+    (u'发布时间', False, lambda w: w.publish_time_text),
+    (u'发布工具', False, lambda w: w.publish_tool),
+    (u'点赞数', False, lambda w: w.up_num),
+    (u'转发数', False, lambda w: w.retweet_num),
+    (u'评论数', False, lambda w: w.comment_num),
+)
+
+TXT_HEADER = (u'用户信息\n用户昵称：%s\n用户id: %d\n微博数: %s\n关注数: %s\n'
+              u'粉丝数: %s\n\n%s微博内容: \n')
+TXT_WEIBO = (u'%d:%s\n微博位置: %s\n发布时间: %s\n点赞数: %s   转发数: %s   '
+             u'评论数: %s\n发布工具: %s\n\n')
+
+
+class CsvWriter(object):
+    """csv结果文件的写入器,每个用户只创建一次,第一次写入时打开文件并保持打开"""
+
+    def __init__(self, file_path, only_original):
+        self.file_path = file_path
+        columns = [c for c in CSV_COLUMNS if not (only_original and c[1])]
+        self.headers = [c[0] for c in columns]
+        self.getters = [c[2] for c in columns]
+        self.file = None
+        self.writer = None
+
+    def open(self):
+        """以追加方式打开csv文件,新文件以BOM开头"""
+        if sys.version < '3':  # python2.x
+            reload(sys)
+            sys.setdefaultencoding('utf-8')
+            self.file = open(self.file_path, 'ab')
+            if self.file.tell() == 0:
+                self.file.write(codecs.BOM_UTF8)
+        else:  # python3.x
+            self.file = open(self.file_path,
+                             'a',
+                             encoding='utf-8-sig',
+                             newline='')
+        self.writer = csv.writer(self.file)
+
+    def write(self, weibos, write_headers):
+        """写入一批微博并写入磁盘"""
+        if self.file is None:
+            self.open()
+        if write_headers:
+            self.writer.writerow(self.headers)
+        getters = self.getters
+        self.writer.writerows([[get(w) for get in getters] for w in weibos])
+        self.file.flush()
+
+    def close(self):
+        """关闭csv文件"""
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            self.writer = None
+
+
+class TxtWriter(object):
+    """txt结果文件的写入器,每个用户只创建一次,第一次写入时打开文件并保持打开"""
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.file = None
+
+    def write(self, weibos, start_num, header=u''):
+        """写入一批微博并写入磁盘,start_num为第一条微博的序号"""
+        if self.file is None:
+            self.file = open(self.file_path, 'ab')
+        result = header + u''.join([
+            TXT_WEIBO % (start_num + i, w.overview, w.publish_place,
+                         w.publish_time_text, w.up_num, w.retweet_num,
+                         w.comment_num, w.publish_tool)
+            for i, w in enumerate(weibos)
+        ])
+        self.file.write(result.encode('utf-8'))
+        self.file.flush()
+
+    def close(self):
+        """关闭txt文件"""
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+SQLITE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS user (
+    user_id INTEGER PRIMARY KEY,
+    nickname TEXT,
+    weibo_num INTEGER,
+    following INTEGER,
+    followers INTEGER,
+    updated_at TEXT
+);
+CREATE TABLE IF NOT EXISTS weibo (
+    id TEXT PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    url TEXT,
+    is_original INTEGER,
+    original_user TEXT,
+    retweet_reason TEXT,
+    content TEXT,
+    overview TEXT,
+    video_url TEXT,
+    publish_place TEXT,
+    publish_time TEXT,
+    publish_tool TEXT,
+    up_num INTEGER,
+    retweet_num INTEGER,
+    comment_num INTEGER,
+    updated_at TEXT
+);
+CREATE INDEX IF NOT EXISTS weibo_user_time ON weibo (user_id, publish_time);
+CREATE INDEX IF NOT EXISTS weibo_time ON weibo (publish_time);
+CREATE TABLE IF NOT EXISTS picture (
+    weibo_id TEXT NOT NULL,
+    is_retweet INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    url TEXT NOT NULL,
+    PRIMARY KEY (weibo_id, is_retweet, position)
+);
+'''
+
+
 class Weibo(object):
-    config = {}
 
     def __load_config(self, config, key, default_value, presets=None, errmsg=None):
-        if not key in config:
+        if config.get(key) is None:
             self.config[key] = default_value
         elif presets == None or config[key] in presets:
             self.config[key] = config[key]
@@ -31,45 +879,304 @@ class Weibo(object):
         else:
             self.config[key] = default_value
 
-    def __init__(self, user_id, config={}):
-        """Weibo类初始化"""
+    def __load_int_config(self, config, key, default_value, minimum, errmsg):
+        self.__load_config(config, key, default_value)
+        value = self.config[key]
+        if isinstance(value, bool) or not isinstance(value, int) or value < minimum:
+            sys.exit(errmsg)
+
+    def __load_float_config(self, config, key, default_value, errmsg):
+        self.__load_config(config, key, default_value)
+        value = self.config[key]
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or value <= 0:
+            sys.exit(errmsg)
+
+    def __load_date_config(self, config, key, errmsg):
+        """读取yyyy-mm-dd形式的日期,未设置时为None"""
+        self.__load_config(config, key, '')
+        value = self.config[key]
+        if value:
+            try:
+                self.config[key] = datetime.strptime(str(value), '%Y-%m-%d')
+            except ValueError:
+                sys.exit(errmsg)
+        else:
+            self.config[key] = None
+
+    def __init__(self,
+                 user_id,
+                 config={},
+                 session=None,
+                 rate_limiter=None,
+                 download_rate_limiter=None,
+                 response_cache=None,
+                 media_store=None):
+        """Weibo类初始化,session、限速器、响应缓存和图片/视频存储可由多个Weibo实例共享"""
         if not isinstance(user_id, int):
             sys.exit(u'user_id值应为一串数字形式,请重新输入')
         if not isinstance(config, dict):
             sys.exit(u'config值应为字典形式,请重新输入')
+        self.config = {}
         self.__load_config(config, 'only_original', 0, [0, 1], u'only_original值应为0或1,0代表要爬取用户的全部微博,1代表只爬取用户的原创微博,请重新输入')
         self.__load_config(config, 'pic_download', 0, [0, 1], u'pic_download值应为0或1,0代表不下载微博原始图片,1代表下载,请重新输入')
         self.__load_config(config, 'video_download', 0, [0, 1], u'video_download值应为0或1,0代表不下载微博视频,1代表下载,请重新输入')
         self.__load_config(config, 'order', 0, ['time asc', 'time desc'], u'order值应为time asc或time desc,time asc代表时间升序,time desc代表时间降序,请重新输入')
         self.__load_config(config, 'cookie', '')
         self.__load_config(config, 'debug', False, [True, False], u'debug值应为0或1,0代表关闭测试输出,1代表开启,请重新输入')
+        self.__load_config(config, 'resume', 1, [0, 1], u'resume值应为0或1,0代表每次从头爬取,1代表从上次中断处继续爬取,请重新输入')
+        self.__load_config(config, 'incremental', 0, [0, 1], u'incremental值应为0或1,0代表爬取全部微博,1代表只爬取上次运行后发布的新微博,请重新输入')
+        self.__load_date_config(config, 'since_date', u'since_date值应为yyyy-mm-dd形式的日期,代表只爬取该日期及之后发布的微博,请重新输入')
+        self.__load_date_config(config, 'until_date', u'until_date值应为yyyy-mm-dd形式的日期,代表只爬取该日期及之前发布的微博,请重新输入')
+        if (self.config['since_date'] and self.config['until_date']
+                and self.config['since_date'] > self.config['until_date']):
+            sys.exit(u'since_date不能晚于until_date,请重新输入')
+        self.__load_int_config(config, 'start_page', 1, 1, u'start_page值应为正整数,代表从微博列表的第几页开始爬取,请重新输入')
+        self.__load_int_config(config, 'end_page', 0, 0, u'end_page值应为非负整数,代表爬取到微博列表的第几页,0代表最后一页,请重新输入')
+        if 0 < self.config['end_page'] < self.config['start_page']:
+            sys.exit(u'end_page不能小于start_page,请重新输入')
+        self.__load_int_config(config, 'pool_connections', 10, 1, u'pool_connections值应为正整数,代表连接池缓存的主机数,请重新输入')
+        self.__load_int_config(config, 'pool_maxsize', 10, 1, u'pool_maxsize值应为正整数,代表每个主机的最大连接数,请重新输入')
+        self.__load_config(config, 'keep_alive', 1, [0, 1], u'keep_alive值应为0或1,0代表每次请求后关闭连接,1代表复用连接,请重新输入')
+        self.__load_config(config, 'engine', 'requests', ['requests', 'asyncio'], u'engine值应为requests或asyncio,requests代表使用requests发送请求,asyncio代表使用基于aiohttp的异步引擎,请重新输入')
+        self.__load_int_config(config, 'download_workers', 1, 1, u'download_workers值应为正整数,代表同时下载图片/视频的线程数,请重新输入')
+        self.__load_int_config(config, 'download_host_limit', 4, 1, u'download_host_limit值应为正整数,代表同一主机同时下载的最大文件数,请重新输入')
+        self.__load_int_config(config, 'download_chunk_size', 65536, 1, u'download_chunk_size值应为正整数,代表下载时每次写入文件的字节数,请重新输入')
+        self.__load_float_config(config, 'rate_limit', 2, u'rate_limit值应为正数,代表每秒最多请求多少次微博页面,请重新输入')
+        self.__load_float_config(config, 'download_rate_limit', 20, u'download_rate_limit值应为正数,代表每秒最多请求多少次图片/视频,请重新输入')
+        self.__load_int_config(config, 'max_retries', 10, 0, u'max_retries值应为非负整数,代表请求被限制(418/429/5xx)后的最大重试次数,请重新输入')
+        self.__load_float_config(config, 'timeout', 10, u'timeout值应为正数,代表每次请求的超时秒数,请重新输入')
+        self.__load_int_config(config, 'prefetch_pages', 2, 0, u'prefetch_pages值应为非负整数,代表提前获取的微博页数,请重新输入')
+        self.__load_int_config(config, 'parse_workers', 2, 1, u'parse_workers值应为正整数,代表同时解析微博页面的线程数,请重新输入')
+        self.__load_int_config(config, 'secondary_workers', 4, 1, u'secondary_workers值应为正整数,代表每页同时获取长微博、组图和视频信息的线程数,请重新输入')
+        self.__load_config(config, 'write_sqlite', 0, [0, 1], u'write_sqlite值应为0或1,0代表不写入SQLite数据库,1代表同时写入SQLite数据库,请重新输入')
+        self.__load_config(config, 'sqlite_path', '')
+        self.__load_int_config(config, 'write_pages', 20, 1, u'write_pages值应为正整数,代表每爬取多少页写入一次csv/txt文件并保存断点,请重新输入')
+        self.__load_config(config, 'write_json', 0, [0, 1], u'write_json值应为0或1,0代表不写入json文件,1代表每爬取一页就将微博写入json文件(每行一条微博),请重新输入')
+        self.__load_config(config, 'json_compression', 'none', ['none', 'gzip', 'zstd'], u'json_compression值应为none、gzip或zstd,代表json文件的压缩方式,请重新输入')
+        if self.config['json_compression'] == 'zstd' and zstandard is None:
+            sys.exit(u'使用zstd压缩json文件需要先安装zstandard: pip install zstandard')
+        self.__load_int_config(config, 'json_flush_pages', 1, 1, u'json_flush_pages值应为正整数,代表每爬取多少页将json文件的缓冲区写入磁盘,请重新输入')
+        self.__load_config(config, 'json_fsync', 0, [0, 1], u'json_fsync值应为0或1,1代表每次写入json文件时确保数据已写入磁盘(较慢),请重新输入')
+        self.__load_config(config, 'write_columnar', 0, [0, 'parquet', 'arrow'], u'write_columnar值应为0、parquet或arrow,0代表不导出列式文件,parquet代表导出Parquet文件,arrow代表导出Arrow IPC文件,请重新输入')
+        if self.config['write_columnar'] and pyarrow is None:
+            sys.exit(u'导出Parquet/Arrow文件需要先安装pyarrow: pip install pyarrow')
+        if self.config['write_columnar'] == 'parquet' and parquet is None:
+            print(u'当前pyarrow不支持Parquet,改为导出Arrow IPC文件')
+            self.config['write_columnar'] = 'arrow'
+        self.__load_config(config, 'cache', 0, [0, 1], u'cache值应为0或1,0代表不缓存微博页面,1代表将微博页面缓存到磁盘,请重新输入')
+        self.__load_config(config, 'cache_replay', 0, [0, 1], u'cache_replay值应为0或1,0代表正常访问网络,1代表只从缓存中读取微博页面,请重新输入')
+        self.__load_config(config, 'cache_dir', '')
+        self.__load_int_config(config, 'cache_size', 1024, 1, u'cache_size值应为正整数,代表缓存的最大总大小(MB),请重新输入')
+        self.__load_config(config, 'cache_ttl', {})
+        cache_ttl = self.config['cache_ttl']
+        if not isinstance(cache_ttl, dict) or any(
+                key not in ResponseCache.DEFAULT_TTL or isinstance(value, bool)
+                or not isinstance(value, int) or value < -1
+                for key, value in cache_ttl.items()):
+            sys.exit(u'cache_ttl值应为字典形式,键为%s,值为缓存有效期(秒),0代表不缓存,-1代表永不过期,请重新输入' %
+                     ','.join(ResponseCache.DEFAULT_TTL))
+        self.config['cache_ttl'] = dict(ResponseCache.DEFAULT_TTL, **cache_ttl)
+        self.__load_config(config, 'media_store', 0, [0, 1], u'media_store值应为0或1,0代表图片/视频直接保存到各用户文件夹,1代表使用按内容去重的共享存储,请重新输入')
+        self.__load_config(config, 'media_store_dir', '')
+        self.__load_config(config, 'metrics', 0, [0, 1], u'metrics值应为0或1,1代表记录各阶段耗时、请求数等性能指标,爬取结束后写入user_id.metrics.json文件,请重新输入')
+        self.__load_config(config, 'metrics_textfile_dir', '')
+        self.__load_config(config, 'download_existing', 'skip', ['skip', 'verify', 'overwrite'], u'download_existing值应为skip、verify或overwrite,skip代表跳过已存在的图片/视频,verify代表向服务器确认文件未改变后跳过,overwrite代表重新下载,请重新输入')
         self.user_id = user_id  # 用户id,即需要我们输入的数字,如昵称为"Dear-迪丽热巴"的id为1669879400
         self.nickname = ''  # 用户昵称,如“Dear-迪丽热巴”
         self.weibo_num = 0  # 用户全部微博数
         self.got_num = 0  # 爬取到的微博数
         self.following = 0  # 用户关注数
         self.followers = 0  # 用户粉丝数
-        self.weibo = []  # 存储爬取到的所有微博信息
+        self.weibo = []  # 存储尚未写入文件的微博信息,写入后即清空
+        self.first_weibo = None  # 爬取到的第一条微博
+        self.weibo_ids = set()  # 已爬取的微博id,用于断点续爬时去重
+        self.history = None  # 增量爬取时上次爬取结果的微博id、最新发布时间和微博数
+        self.history_pages = set()  # 增量爬取时遇到上次爬取过的微博的页码
+        self.since_time = self.config['since_date']  # 只爬取此时间及之后发布的微博
+        self.until_time = None  # 只爬取此时间之前发布的微博
+        if self.config['until_date']:
+            self.until_time = self.config['until_date'] + timedelta(days=1)
+        self.bound_pages = set()  # 按爬取顺序已越过since_date或until_date的页码
+        self.probed_pages = {}  # 确定爬取范围时已获取的页面,爬取时不再重复请求
+        self.prefetched = {}  # 异步引擎中已获取的长微博、组图和视频信息的响应,解析时不再重复请求
+        self.crawl_complete = False  # 是否已成功爬取全部需要爬取的页面
+        self.file_suffix = self.get_file_suffix()  # 只爬取部分页码或日期时结果文件名的后缀
+        self.session = session or self.create_session()  # 所有页面和图片/视频请求共用的HTTP会话
+        self.rate_limiter = rate_limiter or RateLimiter(
+            self.config['rate_limit'])  # 微博页面请求的限速器
+        self.download_rate_limiter = download_rate_limiter or RateLimiter(
+            self.config['download_rate_limit'])  # 图片/视频下载的限速器
+        self.download_lock = threading.Lock()  # 保护下载线程共享的状态和not_downloaded.txt
+        self.host_semaphores = {}  # 每个主机的下载并发信号量
+        self.secondary_executor = None  # 获取长微博、组图和视频信息的线程池
+        self.sqlite_connection = None  # SQLite数据库连接,只在爬取该用户的线程中使用
+        self.columnar_parts = 0  # 本次运行已写入的Parquet/Arrow文件数
+        self.csv_writer = None  # csv文件写入器
+        self.txt_writer = None  # txt文件写入器
+        self.json_file = None  # json文件,只在爬取该用户的线程中使用
+        self.json_pages = 0  # json文件自上次写入磁盘后写入的页数
+        self.response_cache = response_cache  # 微博页面的磁盘缓存
+        if (not self.response_cache
+                and (self.config['cache'] or self.config['cache_replay'])):
+            self.response_cache = ResponseCache(
+                self.config['cache_dir'] or os.path.split(
+                    os.path.realpath(__file__))[0] + os.sep + 'cache',
+                self.config['cache_ttl'],
+                self.config['cache_size'] * 1024 * 1024,
+                self.config['cache_replay'])
+        self.media_store = media_store  # 按内容去重的图片/视频存储
+        if not self.media_store and self.config['media_store']:
+            self.media_store = MediaStore(
+                self.config['media_store_dir'] or
+                os.path.split(os.path.realpath(__file__))[0] + os.sep +
+                'weibo' + os.sep + '.media')
+        self.publish_time_parser = PublishTimeParser(
+            datetime.now())  # 相对发布时间的参考时间,每次爬取开始时更新
+        self.metrics = None  # 性能指标,只记录该用户的爬取过程
+        if self.config['metrics'] or self.config['metrics_textfile_dir']:
+            self.metrics = Metrics(self.user_id)
+        self.download_executor = None  # 下载图片/视频的线程池,微博写入文件后即开始下载
+        self.download_futures = deque()  # 已提交但可能尚未完成的下载任务
+        self.download_num = 0  # 本次运行提交的下载任务总数
+        self.max_pending_downloads = self.config[
+            'download_workers'] * 16  # 排队的下载任务过多时暂停爬取,直到下载跟上
+
+    def create_session(self):
+        """创建带连接池的HTTP会话"""
+        if self.config['engine'] == 'asyncio':
+            return AsyncSession(
+                self.config['pool_maxsize'], self.config['pool_maxsize'] *
+                self.config['pool_connections'], self.config['keep_alive'],
+                self.config['parse_workers'])
+        session = requests.Session()
+        # pool_block为True时,每个主机的并发连接数不会超过pool_maxsize
+        adapter = HTTPAdapter(pool_connections=self.config['pool_connections'],
+                              pool_maxsize=self.config['pool_maxsize'],
+                              pool_block=True,
+                              max_retries=5)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        if not self.config['keep_alive']:
+            session.headers['Connection'] = 'close'
+        return session
 
     def write_log(self, *args):
         if self.config['debug']:
             print(*args)
 
-    def request(self, url):
-        wait_time = 0
-        while True:
-            # 通过加入步进等待避免被限制。微博页面访问有速度限制，单位时间超过允许
-            # 最大次数会被系统限制(一段时间后限制会自动解除)，加入步进等待可处理改
-            # 系统限制。默认是每触发一次限制步进10秒，可根据情况增减步进时间
-            response = requests.get(url, cookies={'Cookie': self.config['cookie']})
-            if response.status_code == 418:
-                wait_time += 10
-                print(u'错误418：访问超限，等待%d秒后重试 %s' % (wait_time, url))
-                sleep(wait_time)
-            else:
+    def request(self, url, media=False, headers=None):
+        """发送请求,media为True时表示下载图片/视频(流式读取,不带cookie)。
+        异步引擎中先使用已获取的响应,其余请求在事件循环中执行"""
+        if self.config['engine'] == 'asyncio':
+            response = self.prefetched.pop(url, None)
+            if response is None:
+                response = self.session.run(
+                    self.async_request(url, media, headers))
+            return response
+        return self.sync_request(url, media, headers)
+
+    def get_request_args(self, url, media):
+        """获取请求使用的限速器、cookies和url类别"""
+        if media:
+            return self.download_rate_limiter, None, 'media'
+        return (self.rate_limiter, {
+            'Cookie': self.config['cookie']
+        }, ResponseCache.get_url_class(url) or 'other')
+
+    def get_cached_response(self, url, url_class):
+        """从磁盘缓存中读取页面,没有缓存时返回None,只读缓存时返回404响应"""
+        if self.response_cache:
+            content = self.response_cache.get(url)
+            if content is not None:
+                if self.metrics:
+                    self.metrics.add_request(url_class, 'cached')
+                return BufferedResponse(url, 200, {}, content)
+            if self.response_cache.replay:
+                print(u'缓存中没有该页面,跳过 %s' % url)
+                return BufferedResponse(url, 404, {}, b'')
+
+    def check_response(self, response, attempt, url, url_class,
+                       rate_limiter):
+        """记录一次请求的结果,返回False表示需要重试。微博页面访问有速度限制，单位时间超过
+        允许最大次数会被系统限制(一段时间后限制会自动解除)。限速器在请求正常时逐渐加速，
+        被限制时减速并暂停所有请求"""
+        if self.metrics:
+            self.metrics.add_request(url_class, response.status_code)
+        if (response.status_code not in (418, 429)
+                and response.status_code < 500):
+            rate_limiter.on_success()
+            return True
+        response.close()
+        if attempt == self.config['max_retries']:
+            print(u'错误%d：已重试%d次，放弃请求 %s' %
+                  (response.status_code, attempt, url))
+            return True
+        wait_time = rate_limiter.on_limited(attempt)
+        if self.metrics:
+            self.metrics.add_backoff(wait_time)
+        print(u'错误%d：访问超限，等待%d秒后重试 %s' %
+              (response.status_code, wait_time, url))
+        return False
+
+    def save_response(self, url, url_class, response):
+        """缓存页面并记录下载的字节数"""
+        # 被重定向的响应(如cookie失效时跳转到的登录页)不是该url的内容,不缓存
+        if (self.response_cache and response.status_code == 200
+                and not response.history):
+            self.response_cache.set(url, response.content)
+        if self.metrics:
+            self.metrics.add_bytes(url_class, len(response.content))
+
+    @timed('request')
+    def sync_request(self, url, media=False, headers=None):
+        """使用requests发送请求,被限制时等待后重试"""
+        rate_limiter, cookies, url_class = self.get_request_args(url, media)
+        if not media:
+            response = self.get_cached_response(url, url_class)
+            if response is not None:
+                return response
+        for attempt in range(self.config['max_retries'] + 1):
+            rate_limiter.acquire()
+            response = self.session.get(url,
+                                        cookies=cookies,
+                                        timeout=self.config['timeout'],
+                                        stream=media,
+                                        headers=headers)
+            if self.check_response(response, attempt, url, url_class,
+                                   rate_limiter):
+                break
+        if not media:
+            self.save_response(url, url_class, response)
+        return response
+
+    @timed('request')
+    async def async_request(self, url, media=False, headers=None):
+        """sync_request的协程版本,在异步引擎的事件循环中执行,等待限速和退避时不占用线程,
+        读写磁盘缓存在工作线程池中执行"""
+        rate_limiter, cookies, url_class = self.get_request_args(url, media)
+        if not media and self.response_cache:
+            response = await self.session.run_in_executor(
+                self.get_cached_response, url, url_class)
+            if response is not None:
+                return response
+        for attempt in range(self.config['max_retries'] + 1):
+            await rate_limiter.async_acquire()
+            response = await self.session.get(url,
+                                              cookies=cookies,
+                                              timeout=self.config['timeout'],
+                                              stream=media,
+                                              headers=headers)
+            if self.check_response(response, attempt, url, url_class,
+                                   rate_limiter):
                 break
+        if not media and self.response_cache:
+            await self.session.run_in_executor(self.save_response, url,
+                                               url_class, response)
+        elif not media:
+            self.save_response(url, url_class, response)
         return response
 
+    @timed('deal_html')
     def deal_html(self, url):
         """处理html"""
         try:
@@ -80,12 +1187,21 @@ class Weibo(object):
             print('Error: ', e)
             traceback.print_exc()
 
+    @timed('deal_html')
+    async def async_deal_html(self, url):
+        """deal_html的协程版本,html在工作线程池中解析"""
+        try:
+            response = await self.async_request(url)
+            return await self.session.run_in_executor(etree.HTML,
+                                                      response.content)
+        except Exception as e:
+            print('Error: ', e)
+            traceback.print_exc()
+
     def deal_garbled(self, info):
         """处理乱码"""
         try:
-            info = (info.xpath('string(.)').replace(u'\u200b', '').encode(
-                sys.stdout.encoding, 'ignore').decode(sys.stdout.encoding))
-            return info
+            return normalize_text(info)
         except Exception as e:
             print('Error: ', e)
             traceback.print_exc()
@@ -151,17 +1267,21 @@ class Weibo(object):
             traceback.print_exc()
         return u'网络出错'
 
-    def get_original_weibo(self, info, weibo_id):
-        """获取原创微博"""
+    def set_long_weibo(self, weibo, weibo_content):
+        """用获取到的长原创微博全文替换微博内容"""
+        if weibo_content:
+            weibo.overview = weibo.content = weibo_content
+
+    def get_original_weibo(self, node, fetches):
+        """获取原创微博,长微博全文的请求加入fetches延后执行"""
         try:
-            weibo_content = self.deal_garbled(info)
+            weibo_content = node.text
             weibo_content = weibo_content[:weibo_content.rfind(u'赞')]
-            a_text = info.xpath('div//a/text()')
+            a_text = XPATH_DIV_A_TEXT(node.info)
             if u'全文' in a_text:
-                weibo_link = 'https://weibo.cn/comment/' + weibo_id + '?ckAll=1'
-                wb_content = self.get_long_weibo(weibo_link)
-                if wb_content:
-                    weibo_content = wb_content
+                weibo_link = 'https://weibo.cn/comment/' + node.id + '?ckAll=1'
+                fetches.append(
+                    (self.get_long_weibo, weibo_link, self.set_long_weibo))
             return {'overview': weibo_content, 'origin': weibo_content,
                     'original_user': u'原创', 'retweet_reason': ''}
         except Exception as e:
@@ -178,72 +1298,86 @@ class Weibo(object):
             print('Error: ', e)
             traceback.print_exc()
 
-    def get_retweet(self, info, weibo_id):
-        """获取转发微博"""
+    def get_retweet_overview(self, retweet_reason, original_user, wb_content):
+        """获取转发微博总览"""
+        return (retweet_reason + '\n' + u'原始用户: ' + original_user + '\n' +
+                u'转发内容: ' + wb_content)
+
+    def set_long_retweet(self, weibo, wb_content):
+        """用获取到的长转发微博全文替换被转发微博内容"""
+        if wb_content:
+            weibo.content = wb_content
+            weibo.overview = self.get_retweet_overview(
+                weibo.retweet_reason, weibo.original_user, wb_content)
+
+    def get_retweet(self, node, fetches):
+        """获取转发微博,长转发微博全文的请求加入fetches延后执行"""
         try:
-            original_user = info.xpath("div/span[@class='cmt']/a/text()")
+            original_user = [
+                text for span in node.cmt for a in XPATH_A(span)
+                for text in XPATH_TEXT(a)
+            ]
             if original_user:
                 original_user = original_user[0]
-                wb_content = self.deal_garbled(info)
+                wb_content = node.text
                 wb_content = wb_content[wb_content.find(':') +
                                         1:wb_content.rfind(u'赞')]
                 wb_content = wb_content[:wb_content.rfind(u'赞')]
-                a_text = info.xpath('div//a/text()')
+                a_text = XPATH_DIV_A_TEXT(node.info)
                 if u'全文' in a_text:
-                    weibo_link = 'https://weibo.cn/comment/' + weibo_id
-                    weibo_content = self.get_long_retweet(weibo_link)
-                    if weibo_content:
-                        wb_content = weibo_content
+                    weibo_link = 'https://weibo.cn/comment/' + node.id
+                    fetches.append((self.get_long_retweet, weibo_link,
+                                    self.set_long_retweet))
             else:
                 original_user = u'已删除'
                 wb_content = u'转发微博已被删除'
-            retweet_reason = self.deal_garbled(info.xpath('div')[-1])
+            retweet_reason = node.last_div_text
             retweet_reason = retweet_reason[retweet_reason.find(':') +
                                         1:retweet_reason.rindex(u'赞')]
-            wb_overview = (retweet_reason + '\n' + u'原始用户: ' + original_user +
-                          '\n' + u'转发内容: ' + wb_content)
+            wb_overview = self.get_retweet_overview(retweet_reason,
+                                                    original_user, wb_content)
             return {'overview': wb_overview, 'origin': wb_content,
                     'original_user': original_user, 'retweet_reason': retweet_reason}
         except Exception as e:
             print('Error: ', e)
             traceback.print_exc()
 
-    def is_original(self, info):
+    def is_original(self, node):
         """判断微博是否为原创微博"""
-        is_original = info.xpath("div/span[@class='cmt']")
-        if len(is_original) > 3:
+        if len(node.cmt) > 3:
             return False
         else:
             return True
 
-    def get_weibo_content(self, info, is_original):
+    def get_weibo_content(self, node, is_original, fetches):
         """获取微博内容"""
         try:
-            weibo_id = info.xpath('@id')[0][2:]
             if is_original:
-                weibo_content = self.get_original_weibo(info, weibo_id)
+                weibo_content = self.get_original_weibo(node, fetches)
             else:
-                weibo_content = self.get_retweet(info, weibo_id)
+                weibo_content = self.get_retweet(node, fetches)
             self.write_log(weibo_content)
             return weibo_content
         except Exception as e:
             print('Error: ', e)
             traceback.print_exc()
 
-    def get_publish_place(self, info):
+    def get_publish_place(self, node):
         """获取微博发布位置"""
         try:
-            div_first = info.xpath('div')[0]
-            a_list = div_first.xpath('a')
+            div_first = node.divs[0]
+            a_list = XPATH_A(div_first)
             publish_place = u'无'
             for a in a_list:
-                if ('place.weibo.com' in a.xpath('@href')[0]
-                        and a.xpath('text()')[0] == u'显示地图'):
-                    weibo_a = div_first.xpath("span[@class='ctt']/a")
+                if ('place.weibo.com' in a.get('href')
+                        and XPATH_TEXT(a)[0] == u'显示地图'):
+                    weibo_a = XPATH_CTT_A(div_first)
                     if len(weibo_a) >= 1:
                         publish_place = weibo_a[-1]
-                        if (u'视频' == div_first.xpath(
-                                "span[@class='ctt']/a/text()")[-1][-2:]):
+                        if (u'视频' == [
+                                text for ctt_a in weibo_a
+                                for text in XPATH_TEXT(ctt_a)
+                        ][-1][-2:]):
                             if len(weibo_a) >= 2:
                                 publish_place = weibo_a[-2]
                             else:
@@ -256,59 +1390,39 @@ class Weibo(object):
             print('Error: ', e)
             traceback.print_exc()
 
-    def get_publish_time(self, info):
+    def get_publish_info(self, node):
+        """获取微博发布时间和发布工具,同一条微博只解析一次"""
+        if node.publish_info is None:
+            node.publish_info = self.publish_time_parser.parse(node.time_text)
+        return node.publish_info
+
+    def get_publish_time(self, node):
         """获取微博发布时间"""
         try:
-            str_time = info.xpath("div/span[@class='ct']")
-            str_time = self.deal_garbled(str_time[0])
-            publish_time = str_time.split(u'来自')[0]
-            if u'刚刚' in publish_time:
-                publish_time = datetime.now().strftime('%Y-%m-%d %H:%M')
-            elif u'分钟' in publish_time:
-                minute = publish_time[:publish_time.find(u'分钟')]
-                minute = timedelta(minutes=int(minute))
-                publish_time = (datetime.now() -
-                                minute).strftime('%Y-%m-%d %H:%M')
-            elif u'今天' in publish_time:
-                today = datetime.now().strftime('%Y-%m-%d')
-                time = publish_time[3:]
-                publish_time = today + ' ' + time
-            elif u'月' in publish_time:
-                year = datetime.now().strftime('%Y')
-                month = publish_time[0:2]
-                day = publish_time[3:5]
-                time = publish_time[7:12]
-                publish_time = year + '-' + month + '-' + day + ' ' + time
-            else:
-                publish_time = publish_time[:16]
-            self.write_log(u'微博发布时间: ' + publish_time)
+            publish_time = self.get_publish_info(node)[0]
+            self.write_log(u'微博发布时间: ' +
+                           WeiboRecord.format_time(publish_time))
             return publish_time
         except Exception as e:
             print('Error: ', e)
             traceback.print_exc()
 
-    def get_publish_tool(self, info):
+    def get_publish_tool(self, node):
         """获取微博发布工具"""
         try:
-            str_time = info.xpath("div/span[@class='ct']")
-            str_time = self.deal_garbled(str_time[0])
-            if len(str_time.split(u'来自')) > 1:
-                publish_tool = str_time.split(u'来自')[1]
-            else:
-                publish_tool = u'无'
+            publish_tool = self.get_publish_info(node)[1]
             self.write_log(u'微博发布工具: ' + publish_tool)
             return publish_tool
         except Exception as e:
             print('Error: ', e)
             traceback.print_exc()
 
-    def get_weibo_footer(self, info):
+    def get_weibo_footer(self, node):
         """获取微博点赞数、转发数、评论数"""
         try:
             footer = {}
             pattern = r'\d+'
-            str_footer = info.xpath('div')[-1]
-            str_footer = self.deal_garbled(str_footer)
+            str_footer = node.last_div_text
             str_footer = str_footer[str_footer.rfind(u'赞'):]
             weibo_footer = re.findall(pattern, str_footer, re.M)
 
@@ -328,57 +1442,71 @@ class Weibo(object):
             print('Error: ', e)
             traceback.print_exc()
 
-    def extract_picture_urls(self, info, weibo_id):
-        """提取微博原始图片url"""
+    def get_all_pictures(self, all_pic):
+        """获取组图页面中全部图片的原始url"""
         try:
-            a_list = info.xpath('div/a/@href')
+            selector = self.deal_html(all_pic)
+            preview_picture_list = selector.xpath('//img/@src')
+            return [
+                p.replace('/thumb180/', '/large/')
+                for p in preview_picture_list
+            ]
+        except Exception as e:
+            print('Error: ', e)
+            traceback.print_exc()
+        return []
+
+    def extract_picture_urls(self, info, weibo_id, fetches, key):
+        """提取微博原始图片url,组图页面的请求加入fetches延后执行,结果写入微博的key字段"""
+        try:
+            a_list = XPATH_DIV_A_HREF(info)
             first_pic = 'https://weibo.cn/mblog/pic/' + weibo_id + '?rl=0'
             all_pic = 'https://weibo.cn/mblog/picAll/' + weibo_id + '?rl=1'
             if first_pic in a_list:
                 if all_pic in a_list:
-                    selector = self.deal_html(all_pic)
-                    preview_picture_list = selector.xpath('//img/@src')
-                    picture_list = [
-                        p.replace('/thumb180/', '/large/')
-                        for p in preview_picture_list
-                    ]
-                    picture_urls = ','.join(picture_list)
+                    fetches.append(
+                        (self.get_all_pictures, all_pic,
+                         lambda weibo, urls: setattr(weibo, key, urls)))
+                    picture_urls = []
                 else:
-                    if info.xpath('.//img/@src'):
-                        preview_picture = info.xpath('.//img/@src')[-1]
-                        picture_urls = preview_picture.replace(
-                            '/wap180/', '/large/')
+                    preview_picture_list = XPATH_IMG_SRC(info)
+                    if preview_picture_list:
+                        preview_picture = preview_picture_list[-1]
+                        picture_urls = [
+                            preview_picture.replace('/wap180/', '/large/')
+                        ]
                     else:
                         sys.exit(
                             u"爬虫微博可能被设置成了'不显示图片'，请前往"
                             u"'https://weibo.cn/account/customize/pic'，修改为'显示'"
                         )
             else:
-                picture_urls = u'无'
+                picture_urls = []
             return picture_urls
         except Exception as e:
             print('Error: ', e)
             traceback.print_exc()
-        return u'无'
+        return []
 
-    def get_picture_urls(self, info, is_original):
+    def get_picture_urls(self, node, is_original, fetches):
         """获取微博原始图片url"""
         try:
-            weibo_id = info.xpath('@id')[0][2:]
-            picture_urls = {'original_pictures': u'无', 'retweet_pictures': u'无'}
+            picture_urls = {'original_pictures': [], 'retweet_pictures': []}
             if is_original:
-                original_pictures = self.extract_picture_urls(info, weibo_id)
+                original_pictures = self.extract_picture_urls(
+                    node.info, node.id, fetches, 'original_pictures')
                 picture_urls['original_pictures'] = original_pictures
             else:
-                retweet_url = info.xpath("div/a[@class='cc']/@href")[0]
+                retweet_url = XPATH_CC_HREF(node.info)[0]
                 retweet_id = retweet_url.split('/')[-1].split('?')[0]
-                retweet_pictures = self.extract_picture_urls(info, retweet_id)
+                retweet_pictures = self.extract_picture_urls(
+                    node.info, retweet_id, fetches, 'retweet_pictures')
                 picture_urls['retweet_pictures'] = retweet_pictures
-                a_list = info.xpath('div[last()]/a/@href')
-                original_pictures = u'无'
+                a_list = XPATH_A_HREF(node.divs[-1])
+                original_pictures = []
                 for a in a_list:
                     if a.endswith(('.gif', '.jpeg', '.jpg', '.png')):
-                        original_pictures = a
+                        original_pictures = [a]
                         break
                 picture_urls['original_pictures'] = original_pictures
             return picture_urls
@@ -386,116 +1514,346 @@ class Weibo(object):
             print('Error: ', e)
             traceback.print_exc()
 
-    def get_video_url(self, info, is_original):
-        """获取微博视频url"""
+    def get_video_object_url(self, video_link):
+        """获取视频信息中的视频url"""
         try:
             video_url = u'无'
+            wb_info = self.request(video_link).json()
+            v_url = wb_info['data']['object']['stream'].get('hd_url')
+            if not v_url:
+                v_url = wb_info['data']['object']['stream']['url']
+            if v_url:  # 说明该视频不是直播
+                video_url = v_url
+            return video_url
+        except Exception as e:
+            print('Error: ', e)
+            traceback.print_exc()
+        return u'无'
+
+    def get_video_url(self, node, is_original, fetches):
+        """获取微博视频url,视频信息的请求加入fetches延后执行"""
+        try:
             if is_original:
-                div_first = info.xpath('div')[0]
-                a_list = div_first.xpath('.//a')
-                video_link = u'无'
+                a_list = XPATH_ALL_A(node.divs[0])
                 for a in a_list:
-                    if 'm.weibo.cn/s/video/show?object_id=' in a.xpath(
-                            '@href')[0]:
-                        video_link = a.xpath('@href')[0]
+                    href = a.get('href')
+                    if 'm.weibo.cn/s/video/show?object_id=' in href:
+                        video_link = href.replace('m.weibo.cn/s/video/show',
+                                                  'm.weibo.cn/s/video/object')
+                        fetches.append(
+                            (self.get_video_object_url, video_link,
+                             lambda weibo, url: setattr(weibo, 'video_url', url)))
                         break
-                if video_link != u'无':
-                    video_link = video_link.replace(
-                        'm.weibo.cn/s/video/show', 'm.weibo.cn/s/video/object')
-                    wb_info = self.request(video_link).json()
-                    v_url = wb_info['data']['object']['stream'].get(
-                        'hd_url')
-                    if not v_url:
-                        v_url = wb_info['data']['object']['stream']['url']
-                    if v_url:  # 说明该视频不是直播
-                        video_url = v_url
-            return video_url
         except Exception as e:
             print('Error: ', e)
             traceback.print_exc()
         return u'无'
 
+    def run_fetches(self, fetches):
+        """并发执行延后的长微博、组图和视频信息请求,并将结果写回对应的微博"""
+        if self.secondary_executor and len(fetches) > 1:
+            futures = [(weibo, apply,
+                        self.secondary_executor.submit(function, argument))
+                       for weibo, function, argument, apply in fetches]
+            for weibo, apply, future in futures:
+                apply(weibo, future.result())
+        else:
+            for weibo, function, argument, apply in fetches:
+                apply(weibo, function(argument))
+
+    def get_host_semaphore(self, url):
+        """获取url所在主机的并发信号量,异步引擎中为asyncio.Semaphore"""
+        host = urlparse(url).netloc
+        with self.download_lock:
+            if host not in self.host_semaphores:
+                if self.config['engine'] == 'asyncio':
+                    semaphore = asyncio.Semaphore(
+                        self.config['download_host_limit'])
+                else:
+                    semaphore = threading.BoundedSemaphore(
+                        self.config['download_host_limit'])
+                self.host_semaphores[host] = semaphore
+            return self.host_semaphores[host]
+
+    def get_download_headers(self, url, file_path):
+        """获取下载file_path的请求头,文件不需要下载时返回None"""
+        # 下载完成的文件才会从临时文件重命名,存在即说明文件完整
+        exists = (self.config['download_existing'] != 'overwrite'
+                  and os.path.isfile(file_path)
+                  and os.path.getsize(file_path) > 0)
+        if exists and self.config['download_existing'] == 'skip':
+            return None
+        # 已下载过的文件(包括其他用户转发的同一文件)直接链接,不再访问网络
+        if (not exists and self.media_store
+                and self.media_store.get(url, file_path)):
+            return None
+        headers = {}
+        if exists:  # 文件修改时间为服务器返回的Last-Modified
+            headers['If-Modified-Since'] = formatdate(
+                os.path.getmtime(file_path), usegmt=True)
+        elif os.path.isfile(file_path + '.part'):
+            headers['Range'] = 'bytes=%d-' % os.path.getsize(file_path +
+                                                              '.part')
+        return headers
+
+    def check_download_response(self, response, file_path, headers):
+        """检查下载的响应,返回False表示已有文件未改变,不需要重新下载;请求失败时抛出异常"""
+        if response.status_code == 304:
+            return False
+        response.raise_for_status()
+        length = response.headers.get('Content-Length')
+        return not ('If-Modified-Since' in headers and length is not None
+                    and int(length) == os.path.getsize(file_path))
+
+    def open_download_file(self, response, temp_path):
+        """打开临时文件,返回(文件, sha256)。继续下载(206)时追加写入,并先计算已下载部分的sha256"""
+        sha256 = hashlib.sha256()
+        if response.status_code == 206:
+            with open(temp_path, 'rb') as f:
+                for chunk in iter(
+                        lambda: f.read(self.config['download_chunk_size']),
+                        b''):
+                    sha256.update(chunk)
+        return open(temp_path, 'ab' if response.status_code == 206 else
+                    'wb'), sha256
+
+    def write_download_chunk(self, f, sha256, chunk):
+        """写入下载的一块内容"""
+        f.write(chunk)
+        sha256.update(chunk)
+        if self.metrics:
+            self.metrics.add_bytes('media', len(chunk))
+
+    def save_download_file(self, response, url, temp_path, file_path, sha256):
+        """下载完成后将临时文件保存为file_path,修改时间为服务器返回的Last-Modified"""
+        last_modified = parsedate_tz(response.headers.get('Last-Modified') or '')
+        if last_modified:
+            last_modified = mktime_tz(last_modified)
+            os.utime(temp_path, (last_modified, last_modified))
+        if self.media_store:
+            self.media_store.add(url, temp_path, sha256.hexdigest(), file_path)
+        else:
+            os.replace(temp_path, file_path)
+
+    def record_failed_download(self, url, type, weibo_id):
+        """将下载失败的文件记录到not_downloaded.txt,已下载的部分保留,下次运行时继续下载"""
+        error_file = self.get_filepath(type) + os.sep + 'not_downloaded.txt'
+        with self.download_lock:
+            with open(error_file, 'ab') as f:
+                url = weibo_id + ':' + url + '\n'
+                f.write(url.encode('utf-8'))
+
+    @timed('download_one_file')
     def download_one_file(self, url, file_path, type, weibo_id):
-        """下载单个文件(图片/视频)"""
+        """下载单个文件(图片/视频),跳过已存在的文件,继续下载上次未完成的部分"""
+        temp_path = file_path + '.part'
         try:
-            s = requests.Session()
-            s.mount(url, HTTPAdapter(max_retries=5))
-            downloaded = s.get(url, timeout=(5, 10))
-            with open(file_path, 'wb') as f:
-                f.write(downloaded.content)
+            headers = self.get_download_headers(url, file_path)
+            if headers is None:
+                return
+            # 分块写入临时文件,下载完成后再重命名,内存占用与文件大小无关
+            with self.get_host_semaphore(url):
+                response = self.request(url, media=True, headers=headers)
+                if response.status_code == 416:  # 临时文件已失效,重新下载
+                    response.close()
+                    os.remove(temp_path)
+                    response = self.request(url, media=True)
+                try:
+                    if not self.check_download_response(
+                            response, file_path, headers):
+                        return
+                    f, sha256 = self.open_download_file(response, temp_path)
+                    with f:
+                        for chunk in response.iter_content(
+                                chunk_size=self.config['download_chunk_size']):
+                            self.write_download_chunk(f, sha256, chunk)
+                finally:
+                    response.close()
+            self.save_download_file(response, url, temp_path, file_path,
+                                    sha256)
         except Exception as e:
-            error_file = self.get_filepath(
-                type) + os.sep + 'not_downloaded.txt'
-            with open(error_file, 'ab') as f:
-                url = weibo_id + ':' + url + '\n'
-                f.write(url.encode(sys.stdout.encoding))
+            self.record_failed_download(url, type, weibo_id)
             print('Error: ', e)
             traceback.print_exc()
 
-    def download_files(self, type):
-        """下载文件(图片/视频)"""
+    @timed('download_one_file')
+    async def async_download_one_file(self, url, file_path, type, weibo_id):
+        """download_one_file的协程版本,网络请求在事件循环中执行,文件读写在工作线程池中执行"""
+        temp_path = file_path + '.part'
+        run = self.session.run_in_executor
         try:
+            headers = await run(self.get_download_headers, url, file_path)
+            if headers is None:
+                return
+            async with self.get_host_semaphore(url):
+                response = await self.async_request(url,
+                                                    media=True,
+                                                    headers=headers)
+                if response.status_code == 416:  # 临时文件已失效,重新下载
+                    response.close()
+                    await run(os.remove, temp_path)
+                    response = await self.async_request(url, media=True)
+                try:
+                    if not self.check_download_response(
+                            response, file_path, headers):
+                        return
+                    f, sha256 = await run(self.open_download_file, response,
+                                          temp_path)
+                    try:
+                        async for chunk in response.iter_content(
+                                chunk_size=self.config['download_chunk_size']):
+                            await run(self.write_download_chunk, f, sha256,
+                                      chunk)
+                    finally:
+                        f.close()
+                finally:
+                    response.close()
+            await run(self.save_download_file, response, url, temp_path,
+                      file_path, sha256)
+        except Exception as e:
+            self.record_failed_download(url, type, weibo_id)
+            print('Error: ', e)
+            traceback.print_exc()
+
+    def get_download_tasks(self, type, file_dir, weibos):
+        """获取weibos中待下载文件的url、保存路径和微博id"""
+        tasks = []
+        for w in weibos:
             if type == 'img':
-                describe = u'图片'
-                key = 'original_pictures'
+                urls = w.original_pictures
             else:
-                describe = u'视频'
-                key = 'video_url'
-            print(u'即将进行%s下载' % describe)
-            file_dir = self.get_filepath(type)
-            for w in tqdm(self.weibo, desc=u'%s下载进度' % describe):
-                if w[key] != u'无':
-                    file_prefix = w['publish_time'][:11].replace(
-                        '-', '') + '_' + w['id']
-                    if type == 'img' and ',' in w[key]:
-                        w[key] = w[key].split(',')
-                        for j, url in enumerate(w[key]):
-                            file_suffix = url[url.rfind('.'):]
-                            file_name = file_prefix + '_' + str(
-                                j + 1) + file_suffix
-                            file_path = file_dir + os.sep + file_name
-                            self.download_one_file(url, file_path, type,
-                                                   w['id'])
+                urls = [w.video_url] if w.video_url != u'无' else []
+            if urls:
+                file_prefix = (w.publish_time_text[:11].replace('-', '') +
+                               '_' + w.id)
+                if len(urls) > 1:
+                    for j, url in enumerate(urls):
+                        file_suffix = url[url.rfind('.'):]
+                        file_name = file_prefix + '_' + str(j +
+                                                            1) + file_suffix
+                        tasks.append(
+                            (url, file_dir + os.sep + file_name, w.id))
+                else:
+                    if type == 'video':
+                        file_suffix = '.mp4'
                     else:
-                        if type == 'video':
-                            file_suffix = '.mp4'
-                        else:
-                            file_suffix = w[key][w[key].rfind('.'):]
-                        file_name = file_prefix + file_suffix
-                        file_path = file_dir + os.sep + file_name
-                        self.download_one_file(w[key], file_path, type,
-                                               w['id'])
-            print(u'%s下载完毕,保存路径:' % describe)
-            print(file_dir)
+                        file_suffix = urls[0][urls[0].rfind('.'):]
+                    file_name = file_prefix + file_suffix
+                    tasks.append(
+                        (urls[0], file_dir + os.sep + file_name, w.id))
+        return tasks
+
+    def get_download_types(self):
+        """获取需要下载的文件类型"""
+        types = []
+        if self.config['cache_replay']:  # 只读缓存时不访问网络,也就不下载图片/视频
+            return types
+        if self.config['pic_download'] == 1:
+            types.append('img')
+        if self.config['video_download'] == 1:
+            types.append('video')
+        return types
+
+    def start_download(self):
+        """创建下载线程池,之后每批微博写入文件时即开始下载其中的图片/视频"""
+        if self.get_download_types():
+            self.download_num = 0
+            if self.config['engine'] == 'asyncio':
+                # 异步引擎中每个下载都是事件循环中的协程,不需要下载线程
+                self.download_executor = self.session
+            else:
+                self.download_executor = ThreadPoolExecutor(
+                    max_workers=self.config['download_workers'])
+
+    def submit_download(self, weibos):
+        """提交weibos中图片/视频的下载任务"""
+        try:
+            if not self.download_executor:
+                return
+            download = self.download_one_file
+            if self.config['engine'] == 'asyncio':
+                download = self.async_download_one_file
+            for type in self.get_download_types():
+                file_dir = self.get_filepath(type)
+                for url, file_path, weibo_id in self.get_download_tasks(
+                        type, file_dir, weibos):
+                    while (self.download_futures
+                           and self.download_futures[0].done()):
+                        self.download_futures.popleft()
+                    if len(self.download_futures
+                           ) >= self.max_pending_downloads:
+                        self.download_futures.popleft().result()
+                    self.download_futures.append(
+                        self.download_executor.submit(download, url,
+                                                      file_path, type,
+                                                      weibo_id))
+                    self.download_num += 1
         except Exception as e:
             print('Error: ', e)
             traceback.print_exc()
 
-    def get_one_weibo(self, info):
-        """获取一条微博的全部信息"""
+    def finish_download(self):
+        """等待剩余的图片/视频下载完成"""
         try:
-            weibo = OrderedDict()
-            is_original = self.is_original(info)
+            if not self.download_executor:
+                return
+            # 进度条只在主线程中更新,下载由线程池中的多个线程并发执行。
+            # 总数为本次运行的全部下载,爬取期间已完成的下载计入初始进度
+            pending = [f for f in self.download_futures if not f.done()]
+            with tqdm(total=self.download_num,
+                      initial=self.download_num - len(pending),
+                      desc=u'图片/视频下载进度') as progress:
+                for _ in as_completed(pending):
+                    progress.update()
+            self.download_futures.clear()
+            if self.download_executor is not self.session:
+                self.download_executor.shutdown()
+            self.download_executor = None
+            for type in self.get_download_types():
+                describe = u'图片' if type == 'img' else u'视频'
+                print(u'%s下载完毕,保存路径:' % describe)
+                print(self.get_filepath(type))
+        except Exception as e:
+            print('Error: ', e)
+            traceback.print_exc()
+
+    @timed('get_one_weibo')
+    def get_one_weibo(self, node, page_fetches=None):
+        """获取一条微博的全部信息。传入page_fetches时,长微博、组图和视频信息的请求
+        会加入page_fetches,由调用者在解析完整页后统一执行,否则在返回前执行"""
+        try:
+            weibo = WeiboRecord()
+            fetches = []
+            is_original = self.is_original(node)
             if (not self.config['only_original']) or is_original:
-                weibo['id'] = info.xpath('@id')[0][2:]
-                weibo['url'] = 'https://weibo.com/' + str(self.user_id) + '/' + weibo['id']
-                content = self.get_weibo_content(info, is_original)  # 微博内容
-                weibo['overview'] = content['overview']  # 微博总览
-                weibo['is_original'] = is_original  # 是否原创微博
-                weibo['original_user'] = content['original_user']  # 原作者
-                weibo['retweet_reason'] = content['retweet_reason']  # 转发内容
-                weibo['content'] = content['origin']  # 微博内容
-                picture_urls = self.get_picture_urls(info, is_original)
-                weibo['original_pictures'] = picture_urls['original_pictures']  # 原创图片url
-                weibo['retweet_pictures'] = picture_urls['retweet_pictures']  # 转发图片url
-                weibo['video_url'] = self.get_video_url(info, is_original)  # 微博视频url
-                weibo['publish_place'] = self.get_publish_place(info)  # 微博发布位置
-                weibo['publish_time'] = self.get_publish_time(info)  # 微博发布时间
-                weibo['publish_tool'] = self.get_publish_tool(info)  # 微博发布工具
-                footer = self.get_weibo_footer(info)
-                weibo['up_num'] = footer['up_num']  # 微博点赞数
-                weibo['retweet_num'] = footer['retweet_num']  # 转发数
-                weibo['comment_num'] = footer['comment_num']  # 评论数
+                weibo.id = node.id
+                weibo.url = 'https://weibo.com/' + str(self.user_id) + '/' + weibo.id
+                content = self.get_weibo_content(node, is_original, fetches)  # 微博内容
+                weibo.overview = content['overview']  # 微博总览
+                weibo.is_original = is_original  # 是否原创微博
+                weibo.original_user = content['original_user']  # 原作者
+                weibo.retweet_reason = content['retweet_reason']  # 转发内容
+                weibo.content = content['origin']  # 微博内容
+                picture_urls = self.get_picture_urls(node, is_original, fetches)
+                weibo.original_pictures = picture_urls['original_pictures']  # 原创图片url列表
+                weibo.retweet_pictures = picture_urls['retweet_pictures']  # 转发图片url列表
+                weibo.video_url = self.get_video_url(node, is_original, fetches)  # 微博视频url
+                weibo.publish_place = self.get_publish_place(node)  # 微博发布位置
+                weibo.publish_time = self.get_publish_time(node)  # 微博发布时间
+                if weibo.publish_time is None:
+                    # 只丢弃这一条微博,避免没有发布时间的微博影响同一批的其他微博
+                    print(u'无法获取微博%s的发布时间,已跳过' % node.id)
+                    return None
+                weibo.publish_tool = self.get_publish_tool(node)  # 微博发布工具
+                footer = self.get_weibo_footer(node)
+                weibo.up_num = footer['up_num']  # 微博点赞数
+                weibo.retweet_num = footer['retweet_num']  # 转发数
+                weibo.comment_num = footer['comment_num']  # 评论数
+                fetches = [(weibo, ) + fetch for fetch in fetches]
+                if page_fetches is None:
+                    self.run_fetches(fetches)
+                else:
+                    page_fetches.extend(fetches)
             else:
                 weibo = None
             return weibo
@@ -503,28 +1861,249 @@ class Weibo(object):
             print('Error: ', e)
             traceback.print_exc()
 
-    def get_one_page(self, page):
-        """获取第page页的全部微博"""
+    def is_history_weibo(self, node):
+        """判断微博是否在上次爬取结果中或早于上次爬取的最新微博"""
+        if node.id in self.history['weibo_ids']:
+            return True
+        publish_time = self.get_publish_time(node)
+        return (publish_time is not None
+                and publish_time < self.history['newest_time'])
+
+    def get_page_selector(self, page):
+        """获取第page页的页面,确定爬取范围时已获取过的页面不再重复请求"""
+        selector = self.probed_pages.pop(page, None)
+        if selector is None:
+            selector = self.deal_html(self.get_page_url(page))
+        return selector
+
+    def get_page_times(self, page):
+        """获取第page页各微博的发布时间(按页面中的顺序,不含可能是置顶微博的第一页第一条),
+        页面获取失败时返回None"""
         try:
-            url = 'https://weibo.cn/%d/profile?page=%d' % (self.user_id, page)
-            selector = self.deal_html(url)
-            info = selector.xpath("//div[@class='c']")
-            is_exist = info[0].xpath("div/span[@class='ctt']")
+            selector = self.deal_html(self.get_page_url(page))
+            info = XPATH_WEIBO(selector)
+            if not XPATH_CTT(info[0]):
+                return []
+            nodes = [WeiboNode(weibo_info) for weibo_info in info[:-2]]
+            if page == 1:
+                nodes = nodes[1:] or nodes
+            self.probed_pages[page] = selector
+            return [self.get_publish_info(node)[0] for node in nodes]
+        except Exception as e:
+            print('Error: ', e)
+            traceback.print_exc()
+
+    def get_page_window(self, page_num):
+        """根据start_page、end_page和日期范围确定要爬取的第一页和最后一页。
+        页面按时间降序排列,用二分查找跳过不在日期范围内的页面,另一端在爬取时越过日期后停止"""
+        first_page = self.config['start_page']
+        last_page = min(self.config['end_page'] or page_num, page_num)
+        if self.config['order'] == 'time desc' and self.until_time:
+            # 时间降序时从第一个有until_date及之前微博的页面开始爬取
+            low, high = first_page, last_page
+            while low < high:
+                middle = (low + high) // 2
+                times = self.get_page_times(middle)
+                if times is None:
+                    break
+                if times and times[-1] < self.until_time:
+                    high = middle
+                else:
+                    low = middle + 1
+            first_page = low
+        elif self.config['order'] != 'time desc' and self.since_time:
+            # 时间升序(包括未设置order时的默认顺序)时从最后一个有since_date及之后微博的页面开始爬取
+            low, high = first_page, last_page
+            while low < high:
+                middle = (low + high + 1) // 2
+                times = self.get_page_times(middle)
+                if times is None:
+                    break
+                if times and times[0] >= self.since_time:
+                    low = middle
+                else:
+                    high = middle - 1
+            last_page = high
+        return first_page, last_page
+
+    def get_page_url(self, page):
+        """获取第page页的url"""
+        return 'https://weibo.cn/%d/profile?page=%d' % (self.user_id, page)
+
+    def get_one_page(self, page, selector, page_fetches=None):
+        """获取第page页的全部微博,页面获取失败时返回None。传入page_fetches时,
+        长微博、组图和视频信息的请求会加入page_fetches,由调用者执行,否则在返回前执行"""
+        try:
+            weibos = []
+            fetches = []  # 本页所有微博延后执行的长微博、组图和视频信息请求
+            info = XPATH_WEIBO(selector)
+            is_exist = XPATH_CTT(info[0])
             if is_exist:
                 info_len = len(info) - 2
+                # 增量爬取总是按时间降序爬取,以便遇到已爬取的微博时停止
+                desc = self.config['order'] == 'time desc' or self.history
                 for i in range(0, info_len):
-                    if self.config['order'] == 'time desc':
-                        weibo = self.get_one_weibo(info[i])
+                    if desc:
+                        weibo_info = info[i]
                     else:
-                        weibo = self.get_one_weibo(info[info_len - i - 1])
+                        weibo_info = info[info_len - i - 1]
+                    node = WeiboNode(weibo_info)
+                    if node.id in self.weibo_ids:
+                        continue  # 断点续爬时跳过已写入文件的微博
+                    if self.history and self.is_history_weibo(node):
+                        if page == 1 and i == 0:
+                            continue  # 第一条微博可能是置顶微博,不能据此停止
+                        self.history_pages.add(page)
+                        break
+                    if self.since_time or self.until_time:
+                        publish_time = self.get_publish_time(node)
+                        if publish_time is None:
+                            continue  # 无法获取发布时间的微博会被跳过
+                        if (self.until_time
+                                and publish_time >= self.until_time):
+                            if desc:
+                                continue  # 时间降序时晚于until_date的微博在前
+                            self.bound_pages.add(page)
+                            break
+                        if (self.since_time
+                                and publish_time < self.since_time):
+                            if not desc or (page == 1 and i == 0):
+                                continue  # 时间升序时早于since_date的微博在前
+                            self.bound_pages.add(page)
+                            break
+                    weibo = self.get_one_weibo(node, fetches)
                     if weibo:
-                        self.weibo.append(weibo)
-                        self.got_num += 1
-                        self.write_log('-' * 100)
+                        weibos.append(weibo)
+                if page_fetches is None:
+                    self.run_fetches(fetches)
+                else:
+                    page_fetches.extend(fetches)
+            return weibos
         except Exception as e:
             print('Error: ', e)
             traceback.print_exc()
 
+    async def async_get_one_page(self, page):
+        """异步引擎中获取第page页的全部微博,结果与get_one_page相同。页面和本页的长微博、组图、
+        视频信息都在事件循环中并发请求,解析在工作线程池中执行"""
+        try:
+            selector = self.probed_pages.pop(page, None)
+            if selector is None:
+                selector = await self.async_deal_html(self.get_page_url(page))
+            fetches = []
+            weibos = await self.session.run_in_executor(
+                self.get_one_page, page, selector, fetches)
+            if fetches:
+                urls = [argument for weibo, function, argument, apply in fetches]
+                responses = await asyncio.gather(
+                    *[self.async_request(url) for url in urls],
+                    return_exceptions=True)
+                for url, response in zip(urls, responses):
+                    # 请求出错的url在执行fetches时会重新请求并输出错误
+                    if not isinstance(response, BaseException):
+                        self.prefetched[url] = response
+                await self.session.run_in_executor(self.run_fetches, fetches)
+            return weibos
+        except Exception as e:
+            print('Error: ', e)
+            traceback.print_exc()
+
+    def iter_page_weibo_async(self, pages):
+        """异步引擎中的iter_page_weibo,各页面是事件循环中的协程,当前线程只等待结果"""
+        pending = deque()
+        pages = iter(pages)
+        try:
+            while True:
+                while len(pending) <= self.config['prefetch_pages']:
+                    page = next(pages, None)
+                    if page is None:
+                        break
+                    pending.append(
+                        self.session.create_task(
+                            self.async_get_one_page(page)))
+                if not pending:
+                    break
+                yield self.session.wait_task(pending.popleft())
+        finally:
+            # 提前结束爬取时取消其余页面,并等待已开始的解析完成
+            self.session.cancel_tasks(list(pending))
+
+    def iter_page_weibo(self, pages):
+        """按pages的顺序依次产出每页的微博,后面的页面在后台线程中预取和解析。
+        调用者提前结束时应关闭该生成器,关闭时会等待正在进行的请求和解析完成"""
+        if self.config['engine'] == 'asyncio':
+            yield from self.iter_page_weibo_async(pages)
+            return
+        fetch_executor = ThreadPoolExecutor(
+            max_workers=self.config['prefetch_pages'] + 1)
+        parse_executor = ThreadPoolExecutor(
+            max_workers=self.config['parse_workers'])
+        self.secondary_executor = ThreadPoolExecutor(
+            max_workers=self.config['secondary_workers'])
+
+        def parse_page(page, selector_future):
+            return self.get_one_page(page, selector_future.result())
+
+        pending = deque()
+        pages = iter(pages)
+        try:
+            while True:
+                # 当前页之外最多提前获取prefetch_pages页
+                while len(pending) <= self.config['prefetch_pages']:
+                    page = next(pages, None)
+                    if page is None:
+                        break
+                    selector_future = fetch_executor.submit(
+                        self.get_page_selector, page)
+                    pending.append((selector_future,
+                                    parse_executor.submit(
+                                        parse_page, page, selector_future)))
+                if not pending:
+                    break
+                yield pending.popleft()[1].result()
+        finally:
+            # 提前结束爬取时取消尚未开始的预取和解析,并等待已开始的完成,
+            # 避免返回后仍有请求发出或使用已关闭的secondary_executor
+            for selector_future, parse_future in pending:
+                parse_future.cancel()
+                selector_future.cancel()
+            fetch_executor.shutdown()
+            parse_executor.shutdown()
+            self.secondary_executor.shutdown()
+            self.secondary_executor = None
+
+    def add_page_weibo(self, weibos):
+        """将一页的微博加入爬取结果"""
+        if self.config['write_sqlite']:
+            self.write_sqlite(weibos)
+        new_weibos = []
+        for weibo in weibos:
+            if weibo.id in self.weibo_ids:
+                continue
+            new_weibos.append(weibo)
+            if self.first_weibo is None:
+                self.first_weibo = weibo
+            self.weibo.append(weibo)
+            self.weibo_ids.add(weibo.id)
+            self.got_num += 1
+            self.write_log('-' * 100)
+        if self.config['write_json']:
+            self.write_json(new_weibos)
+
+    def get_file_suffix(self):
+        """设置了日期或页码范围时,结果写入单独的文件,如user_id_20191210-20191220.csv、
+        user_id_p2-5.csv,不影响全量爬取的结果文件;未设置范围时为空"""
+        suffix = ''
+        if self.since_time or self.until_time:
+            suffix += '_%s-%s' % (
+                self.since_time.strftime('%Y%m%d') if self.since_time else '',
+                self.config['until_date'].strftime('%Y%m%d')
+                if self.until_time else '')
+        if self.config['start_page'] > 1 or self.config['end_page']:
+            suffix += '_p%d-%s' % (self.config['start_page'],
+                                   self.config['end_page'] or '')
+        return suffix
+
     def get_filepath(self, type):
         """获取结果文件路径"""
         try:
@@ -536,72 +2115,39 @@ class Weibo(object):
                 os.makedirs(file_dir)
             if type == 'img' or type == 'video':
                 return file_dir
-            file_path = file_dir + os.sep + '%d' % self.user_id + '.' + type
+            file_path = (file_dir + os.sep + '%d' % self.user_id +
+                         self.file_suffix + '.' + type)
             return file_path
         except Exception as e:
             print('Error: ', e)
             traceback.print_exc()
 
+    def get_csv_writer(self):
+        """获取csv文件写入器"""
+        if self.csv_writer is None:
+            self.csv_writer = CsvWriter(self.get_filepath('csv'),
+                                        self.config['only_original'])
+        return self.csv_writer
+
+    def get_txt_writer(self):
+        """获取txt文件写入器"""
+        if self.txt_writer is None:
+            self.txt_writer = TxtWriter(self.get_filepath('txt'))
+        return self.txt_writer
+
+    def close_writers(self):
+        """关闭csv/txt文件,之后再写入时会重新打开"""
+        for writer in (self.csv_writer, self.txt_writer):
+            if writer is not None:
+                writer.close()
+
     def write_csv(self, wrote_num):
         """将爬取的信息写入csv文件"""
         try:
-            result_headers = []
-            result_headers.append('微博地址')
-            if not self.config['only_original']:
-                result_headers.append('是否为原创微博')
-                result_headers.append('转发内容')
-                result_headers.append('原作者')
-            result_headers.append('微博正文')
-            result_headers.append('原始图片url')
-            if not self.config['only_original']:
-                result_headers.append('被转发微博原始图片地址')
-            result_headers.append('微博视频地址')
-            result_headers.append('发布位置')
-            result_headers.append('发布时间')
-            result_headers.append('发布工具')
-            result_headers.append('点赞数')
-            result_headers.append('转发数')
-            result_headers.append('评论数')
-            result_data = []
-            for w in self.weibo[wrote_num:]:
-                d = []
-                d.append(w['url'])
-                if not self.config['only_original']:
-                    d.append(w['is_original'])
-                    d.append(w['retweet_reason'])
-                    d.append(w['original_user'])
-                d.append(w['content'])
-                d.append(w['original_pictures'])
-                if not self.config['only_original']:
-                    d.append(w['retweet_pictures'])
-                d.append(w['video_url'])
-                d.append(w['publish_place'])
-                d.append(w['publish_time'])
-                d.append(w['publish_tool'])
-                d.append(w['up_num'])
-                d.append(w['retweet_num'])
-                d.append(w['comment_num'])
-                result_data.append(d)
-            if sys.version < '3':  # python2.x
-                reload(sys)
-                sys.setdefaultencoding('utf-8')
-                with open(self.get_filepath('csv'), 'ab') as f:
-                    f.write(codecs.BOM_UTF8)
-                    writer = csv.writer(f)
-                    if wrote_num == 0:
-                        writer.writerows([result_headers])
-                    writer.writerows(result_data)
-            else:  # python3.x
-                with open(self.get_filepath('csv'),
-                          'a',
-                          encoding='utf-8-sig',
-                          newline='') as f:
-                    writer = csv.writer(f)
-                    if wrote_num == 0:
-                        writer.writerows([result_headers])
-                    writer.writerows(result_data)
+            writer = self.get_csv_writer()
+            writer.write(self.weibo, wrote_num == 0)
             print(u'%d条微博写入csv文件完毕,保存路径:' % self.got_num)
-            print(self.get_filepath('csv'))
+            print(writer.file_path)
         except Exception as e:
             print('Error: ', e)
             traceback.print_exc()
@@ -609,66 +2155,454 @@ class Weibo(object):
     def write_txt(self, wrote_num):
         """将爬取的信息写入txt文件"""
         try:
-            temp_result = []
+            writer = self.get_txt_writer()
+            header = u''
             if wrote_num == 0:
-                if self.config['only_original']:
-                    result_header = u'\n\n原创微博内容: \n'
-                else:
-                    result_header = u'\n\n微博内容: \n'
-                result_header = (u'用户信息\n用户昵称：' + self.nickname + u'\n用户id: ' +
-                                 str(self.user_id) + u'\n微博数: ' +
-                                 str(self.weibo_num) + u'\n关注数: ' +
-                                 str(self.following) + u'\n粉丝数: ' +
-                                 str(self.followers) + result_header)
-                temp_result.append(result_header)
-            for i, w in enumerate(self.weibo[wrote_num:]):
-                temp_result.append(
-                    str(wrote_num + i + 1) + ':' + w['overview'] + '\n' +
-                    u'微博位置: ' + w['publish_place'] + '\n' + u'发布时间: ' +
-                    w['publish_time'] + '\n' + u'点赞数: ' + str(w['up_num']) +
-                    u'   转发数: ' + str(w['retweet_num']) + u'   评论数: ' +
-                    str(w['comment_num']) + '\n' + u'发布工具: ' +
-                    w['publish_tool'] + '\n\n')
-            result = ''.join(temp_result)
-            with open(self.get_filepath('txt'), 'ab') as f:
-                f.write(result.encode(sys.stdout.encoding))
+                header = TXT_HEADER % (
+                    self.nickname, self.user_id, self.weibo_num,
+                    self.following, self.followers,
+                    u'原创' if self.config['only_original'] else u'')
+            writer.write(self.weibo, wrote_num + 1, header)
             print(u'%d条微博写入txt文件完毕,保存路径:' % self.got_num)
-            print(self.get_filepath('txt'))
+            print(writer.file_path)
+        except Exception as e:
+            print('Error: ', e)
+            traceback.print_exc()
+
+    def get_json_path(self):
+        """获取json文件路径,压缩时加上对应的扩展名"""
+        suffix = {'none': '', 'gzip': '.gz', 'zstd': '.zst'}
+        return self.get_filepath('ndjson') + suffix[
+            self.config['json_compression']]
+
+    def get_json_file(self, append=True):
+        """打开json文件,append为False时覆盖已有文件"""
+        if self.json_file is None:
+            file_path = self.get_json_path()
+            mode = 'ab' if append else 'wb'
+            if self.config['json_compression'] == 'gzip':
+                self.json_file = gzip.open(file_path, mode)
+            elif self.config['json_compression'] == 'zstd':
+                self.json_file = zstandard.open(file_path, mode)
+            else:
+                self.json_file = open(file_path, mode)
+        return self.json_file
+
+    def write_json(self, weibos):
+        """将一页微博写入json文件,每行一条微博"""
+        try:
+            json_file = self.get_json_file()
+            for w in weibos:
+                w = w.to_dict()
+                w['user_id'] = self.user_id
+                json_file.write(
+                    (json.dumps(w, ensure_ascii=False) + '\n').encode('utf-8'))
+            self.json_pages += 1
+            if self.json_pages >= self.config['json_flush_pages']:
+                self.flush_json()
+        except Exception as e:
+            print('Error: ', e)
+            traceback.print_exc()
+
+    def flush_json(self):
+        """将json文件的缓冲区写入磁盘,压缩文件在此之前写入的内容都可被完整解压"""
+        self.json_pages = 0
+        self.json_file.flush()
+        if self.config['json_fsync']:
+            # 压缩文件对象没有fileno,需对底层文件执行fsync
+            raw_file = getattr(self.json_file, 'fileobj', self.json_file)
+            os.fsync(raw_file.fileno())
+
+    def close_json(self):
+        """关闭json文件"""
+        if self.json_file is not None:
+            self.flush_json()
+            self.json_file.close()
+            self.json_file = None
+            print(u'微博写入json文件完毕,保存路径:')
+            print(self.get_json_path())
+
+    def get_arrow_schema(self):
+        """获取Parquet/Arrow文件的表结构"""
+        return pyarrow.schema([
+            ('id', pyarrow.string()),
+            ('user_id', pyarrow.int64()),
+            ('url', pyarrow.string()),
+            ('is_original', pyarrow.bool_()),
+            ('original_user', pyarrow.string()),
+            ('retweet_reason', pyarrow.string()),
+            ('content', pyarrow.string()),
+            ('overview', pyarrow.string()),
+            ('original_pictures', pyarrow.list_(pyarrow.string())),
+            ('retweet_pictures', pyarrow.list_(pyarrow.string())),
+            ('video_url', pyarrow.string()),
+            ('publish_place', pyarrow.string()),
+            ('publish_time', pyarrow.timestamp('s')),
+            ('publish_tool', pyarrow.string()),
+            ('up_num', pyarrow.int64()),
+            ('retweet_num', pyarrow.int64()),
+            ('comment_num', pyarrow.int64()),
+        ])
+
+    def write_columnar(self, wrote_num):
+        """将尚未写入的微博写入Parquet/Arrow文件。结果为一个文件夹,
+        每次写入一个新的文件(一个row group),可用pandas.read_parquet等直接读取整个文件夹"""
+        try:
+            file_format = self.config['write_columnar']
+            file_dir = self.get_filepath(file_format)
+            # 重新爬取全部微博时清除上次的结果,断点续爬和增量爬取时保留
+            if wrote_num == 0 and not self.history and os.path.isdir(file_dir):
+                shutil.rmtree(file_dir)
+            if not os.path.isdir(file_dir):
+                os.makedirs(file_dir)
+            columns = OrderedDict(
+                (name, []) for name in self.get_arrow_schema().names)
+            for w in self.weibo:
+                columns['id'].append(w.id)
+                columns['user_id'].append(self.user_id)
+                columns['url'].append(w.url)
+                columns['is_original'].append(w.is_original)
+                columns['original_user'].append(w.original_user)
+                columns['retweet_reason'].append(w.retweet_reason)
+                columns['content'].append(w.content)
+                columns['overview'].append(w.overview)
+                columns['original_pictures'].append(w.original_pictures)
+                columns['retweet_pictures'].append(w.retweet_pictures)
+                # 没有视频、位置或发布工具时为null
+                columns['video_url'].append(
+                    None if w.video_url == u'无' else w.video_url)
+                columns['publish_place'].append(
+                    None if w.publish_place == u'无' else w.publish_place)
+                columns['publish_time'].append(w.publish_time)
+                columns['publish_tool'].append(
+                    None if w.publish_tool == u'无' else w.publish_tool)
+                columns['up_num'].append(w.up_num)
+                columns['retweet_num'].append(w.retweet_num)
+                columns['comment_num'].append(w.comment_num)
+            table = pyarrow.Table.from_pydict(columns,
+                                              schema=self.get_arrow_schema())
+            self.columnar_parts += 1
+            file_path = file_dir + os.sep + 'part-%s-%05d.%s' % (
+                datetime.now().strftime('%Y%m%d%H%M%S%f'), self.columnar_parts,
+                file_format)
+            # 先写入临时文件,中断时不会留下不完整的文件
+            if file_format == 'parquet':
+                parquet.write_table(table, file_path + '.tmp')
+            else:
+                with pyarrow.ipc.new_file(file_path + '.tmp',
+                                          table.schema) as writer:
+                    writer.write_table(table)
+            os.replace(file_path + '.tmp', file_path)
+            print(u'%d条微博写入%s文件完毕,保存路径:' % (self.got_num, file_format))
+            print(file_dir)
         except Exception as e:
             print('Error: ', e)
             traceback.print_exc()
 
+    @timed('write_file')
     def write_file(self, wrote_num):
-        """写文件"""
-        if self.got_num > wrote_num:
+        """将尚未写入的微博写入文件并开始下载其中的图片/视频,之后不再保留这些微博"""
+        if self.weibo:
             self.write_csv(wrote_num)
             self.write_txt(wrote_num)
+            if self.config['write_columnar']:
+                self.write_columnar(wrote_num)
+            self.submit_download(self.weibo)
+            self.weibo = []
+
+    def get_sqlite_path(self):
+        """获取SQLite数据库文件路径,默认为所有用户共用的weibo/weibo.db"""
+        if self.config['sqlite_path']:
+            return self.config['sqlite_path']
+        file_dir = os.path.split(
+            os.path.realpath(__file__))[0] + os.sep + 'weibo'
+        if not os.path.isdir(file_dir):
+            os.makedirs(file_dir)
+        return file_dir + os.sep + 'weibo.db'
+
+    def get_sqlite_connection(self):
+        """获取SQLite数据库连接,第一次使用时创建数据库文件和表"""
+        if self.sqlite_connection is None:
+            # 多个用户可同时写入同一个数据库,WAL模式下读写互不阻塞
+            connection = sqlite3.connect(self.get_sqlite_path(), timeout=60)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.executescript(SQLITE_SCHEMA)
+            self.sqlite_connection = connection
+        return self.sqlite_connection
+
+    def write_sqlite(self, weibos):
+        """在一个事务中将一页微博写入SQLite数据库,已存在的微博会更新点赞数等信息"""
+        try:
+            updated_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            weibo_rows = []
+            picture_rows = []
+            for w in weibos:
+                weibo_rows.append(
+                    (w.id, self.user_id, w.url, int(w.is_original),
+                     w.original_user, w.retweet_reason, w.content, w.overview,
+                     w.video_url, w.publish_place, w.publish_time_text,
+                     w.publish_tool, w.up_num, w.retweet_num, w.comment_num,
+                     updated_at))
+                for is_retweet, pictures in enumerate(
+                    [w.original_pictures, w.retweet_pictures]):
+                    for position, url in enumerate(pictures):
+                        picture_rows.append((w.id, is_retweet, position, url))
+            connection = self.get_sqlite_connection()
+            with connection:
+                connection.execute(
+                    '''INSERT INTO user VALUES (?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (user_id) DO UPDATE SET
+                    nickname = excluded.nickname,
+                    weibo_num = excluded.weibo_num,
+                    following = excluded.following,
+                    followers = excluded.followers,
+                    updated_at = excluded.updated_at''',
+                    (self.user_id, self.nickname, self.weibo_num,
+                     self.following, self.followers, updated_at))
+                connection.executemany(
+                    '''INSERT INTO weibo VALUES
+                    (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (id) DO UPDATE SET
+                    content = excluded.content,
+                    overview = excluded.overview,
+                    video_url = excluded.video_url,
+                    up_num = excluded.up_num,
+                    retweet_num = excluded.retweet_num,
+                    comment_num = excluded.comment_num,
+                    updated_at = excluded.updated_at''', weibo_rows)
+                connection.executemany('DELETE FROM picture WHERE weibo_id = ?',
+                                       [(w.id, ) for w in weibos])
+                connection.executemany(
+                    'INSERT INTO picture VALUES (?, ?, ?, ?)', picture_rows)
+        except Exception as e:
+            print('Error: ', e)
+            traceback.print_exc()
+
+    def close_sqlite(self):
+        """关闭SQLite数据库连接"""
+        if self.sqlite_connection is not None:
+            self.sqlite_connection.close()
+            self.sqlite_connection = None
+            print(u'微博写入SQLite数据库完毕,保存路径:')
+            print(self.get_sqlite_path())
+
+    def load_checkpoint(self):
+        """读取断点续爬信息"""
+        try:
+            checkpoint_path = self.get_filepath('checkpoint')
+            if not self.config['resume'] or not os.path.isfile(checkpoint_path):
+                return None
+            with open(checkpoint_path, 'r') as f:
+                checkpoint = json.load(f)
+            # 配置改变或结果文件已被删除时,断点信息不再有效
+            if (checkpoint['order'] != self.config['order']
+                    or checkpoint['only_original'] !=
+                    self.config['only_original']
+                    or (checkpoint['got_num']
+                        and not os.path.isfile(self.get_filepath('csv')))):
+                return None
+            return checkpoint
+        except Exception as e:
+            print('Error: ', e)
+            traceback.print_exc()
+
+    def save_checkpoint(self, crawled_pages, page_num):
+        """保存断点续爬信息,只包含已写入文件的微博"""
+        try:
+            checkpoint = {
+                'user_id': self.user_id,
+                'order': self.config['order'],
+                'only_original': self.config['only_original'],
+                'crawled_pages': crawled_pages,
+                'page_num': page_num,
+                'got_num': self.got_num,
+                'weibo_ids': list(self.weibo_ids),
+            }
+            checkpoint_path = self.get_filepath('checkpoint')
+            with open(checkpoint_path + '.tmp', 'w') as f:
+                json.dump(checkpoint, f)
+            os.replace(checkpoint_path + '.tmp', checkpoint_path)
+        except Exception as e:
+            print('Error: ', e)
+            traceback.print_exc()
+
+    def remove_checkpoint(self):
+        """爬取完成后删除断点续爬信息"""
+        checkpoint_path = self.get_filepath('checkpoint')
+        if os.path.isfile(checkpoint_path):
+            os.remove(checkpoint_path)
+
+    def load_history(self):
+        """读取上次爬取结果中的微博id、最新发布时间和微博数"""
+        try:
+            csv_path = self.get_filepath('csv')
+            if not os.path.isfile(csv_path):
+                return None
+            with open(csv_path, encoding='utf-8-sig', newline='') as f:
+                reader = csv.reader(f)
+                headers = next(reader)
+                if headers != self.get_csv_writer().headers:
+                    print(u'已有csv文件的列与当前only_original配置不一致,无法增量爬取')
+                    return None
+                url_index = headers.index(u'微博地址')
+                time_index = headers.index(u'发布时间')
+                history = {'weibo_ids': set(), 'newest_time': '', 'count': 0}
+                for row in reader:
+                    history['weibo_ids'].add(row[url_index].split('/')[-1])
+                    history['newest_time'] = max(history['newest_time'],
+                                                 row[time_index])
+                    history['count'] += 1
+            if not history['count']:
+                return None
+            # 旧版本写入的"今天"发布的微博时间末尾可能带有空白
+            history['newest_time'] = datetime.strptime(
+                history['newest_time'].strip(), '%Y-%m-%d %H:%M')
+            return history
+        except Exception as e:
+            print('Error: ', e)
+            traceback.print_exc()
+
+    def merge_file(self):
+        """将增量爬取到的新微博合并到已有的csv/txt文件"""
+        try:
+            if not self.got_num:
+                return
+            if self.config['order'] != 'time desc':
+                # 新微博按时间升序(包括未设置order时的默认顺序)追加到文件末尾,序号接着已有微博
+                self.weibo.reverse()
+                self.got_num += self.history['count']
+                self.write_file(self.history['count'])
+                return
+            # 时间降序时新微博位于文件开头,先写入新微博,再追加原有内容
+            csv_path = self.get_filepath('csv')
+            txt_path = self.get_filepath('txt')
+            self.close_writers()
+            os.replace(csv_path, csv_path + '.old')
+            if os.path.isfile(txt_path):
+                os.replace(txt_path, txt_path + '.old')
+            self.write_file(0)
+            self.close_writers()
+            with open(csv_path + '.old', encoding='utf-8-sig',
+                      newline='') as old_file:
+                with open(csv_path, 'a', encoding='utf-8-sig',
+                          newline='') as f:
+                    reader = csv.reader(old_file)
+                    next(reader)
+                    csv.writer(f).writerows(reader)
+            os.remove(csv_path + '.old')
+            if os.path.isfile(txt_path + '.old'):
+                with open(txt_path + '.old', 'rb') as f:
+                    old_txt = f.read().decode('utf-8')
+                # 去掉原有的用户信息,原有微博的序号依次后移
+                body_start = old_txt.find(u'微博内容: \n') + len(u'微博内容: \n')
+                body = re.sub(u'(\\A|发布工具: [^\\n]*\\n\\n)(\\d+):',
+                              lambda m: m.group(1) + str(
+                                  int(m.group(2)) + self.got_num) + ':',
+                              old_txt[body_start:])
+                with open(txt_path, 'ab') as f:
+                    f.write(body.encode('utf-8'))
+                os.remove(txt_path + '.old')
+        except Exception as e:
+            print('Error: ', e)
+            traceback.print_exc()
+
+    def get_incremental_weibo(self, page_num):
+        """增量爬取上次运行后发布的新微博"""
+        print(u'增量爬取,上次爬取的最新微博发布于' +
+              WeiboRecord.format_time(self.history['newest_time']))
+        pages = range(1, page_num + 1)
+        with closing(self.iter_page_weibo(pages)) as page_weibos:
+            for page, weibos in tqdm(zip(pages, page_weibos),
+                                     desc=u'进度',
+                                     total=page_num):
+                if weibos:
+                    self.add_page_weibo(weibos)
+                if page in self.history_pages:
+                    break
+        new_num = self.got_num
+        self.merge_file()
+        self.crawl_complete = True
+        if not self.config['only_original']:
+            print(u'共新增' + str(new_num) + u'条微博')
+        else:
+            print(u'共新增' + str(new_num) + u'条原创微博')
 
     def get_weibo_info(self):
         """获取微博信息"""
         try:
+            self.publish_time_parser = PublishTimeParser(datetime.now())
             url = 'https://weibo.cn/%d/profile' % (self.user_id)
             selector = self.deal_html(url)
             self.get_user_info(selector)  # 获取用户昵称、微博数、关注数、粉丝数
             page_num = self.get_page_num(selector)  # 获取微博总页数
+            # 设置了页码或日期范围时只爬取该范围并写入单独的文件,不使用断点续爬和增量爬取
+            limited = bool(self.file_suffix)
+            checkpoint = None if limited else self.load_checkpoint()
+            # 有未完成的断点时先完成全量爬取,否则增量爬取会遗漏断点之后的微博
+            if self.config['incremental'] and not checkpoint and not limited:
+                self.history = self.load_history()
+                if self.history:
+                    self.get_incremental_weibo(page_num)
+                    return
             wrote_num = 0
-            page1 = 0
-            random_pages = random.randint(1, 5)
-            for page in tqdm(range(1, page_num + 1), desc=u'进度'):
+            start_page = 1
+            crawled_pages = 0  # 从第一页起连续爬取成功的页数
+            if checkpoint:
+                wrote_num = self.got_num = checkpoint['got_num']
+                self.weibo_ids = set(checkpoint['weibo_ids'])
+                crawled_pages = checkpoint['crawled_pages']
+                # 重新爬取上次完成的最后一页,避免因新发或删除微博导致分页偏移而遗漏
+                start_page = max(crawled_pages, 1)
+                print(u'从断点继续爬取,已完成%d页,已写入%d条微博' %
+                      (crawled_pages, wrote_num))
+            elif self.config['write_json']:
+                self.get_json_file(append=False)  # 重新爬取全部微博或该范围时覆盖json文件
+            if limited:
+                first_page, last_page = self.get_page_window(page_num)
+                print(u'共%d页,爬取第%d页到第%d页' %
+                      (page_num, first_page, last_page))
+                page_count = max(last_page - first_page + 1, 0)
                 if self.config['order'] == 'time desc':
-                    self.get_one_page(page)
+                    pages = range(first_page, last_page + 1)
                 else:
-                    self.get_one_page(page_num - page)
-
-                if page % 20 == 0:  # 每爬20页写入一次文件
-                    self.write_file(wrote_num)
-                    wrote_num = self.got_num
+                    pages = range(last_page, first_page - 1, -1)
+            # time asc时从最后一页开始爬取,断点页数按距最后一页的页数计算
+            elif self.config['order'] == 'time desc':
+                page_count = page_num
+                pages = range(start_page, page_num + 1)
+            else:
+                page_count = page_num
+                pages = range(page_num - start_page + 1, 0, -1)
+            visited_pages = 0  # 已爬取的页数,越过日期范围时提前结束
+            with closing(self.iter_page_weibo(pages)) as page_weibos:
+                for page, weibos in tqdm(zip(range(start_page, page_count + 1),
+                                             page_weibos),
+                                         desc=u'进度',
+                                         initial=start_page - 1,
+                                         total=page_count):
+                    visited_pages = page
+                    if weibos is not None:
+                        self.add_page_weibo(weibos)
+                        if crawled_pages == page - 1:
+                            crawled_pages = page
 
-                if page - page1 == random_pages and page < page_num:
-                    page1 = page
-                    random_pages = random.randint(1, 5)
+                    if page % self.config['write_pages'] == 0:  # 每爬write_pages页写入一次文件
+                        self.write_file(wrote_num)
+                        wrote_num = self.got_num
+                        if not limited:
+                            self.save_checkpoint(crawled_pages, page_num)
+                    if pages[page - start_page] in self.bound_pages:
+                        break
 
-            self.write_file(wrote_num)  # 将剩余不足20页的微博写入文件
+            self.write_file(wrote_num)  # 将剩余不足write_pages页的微博写入文件
+            if limited:
+                self.crawl_complete = crawled_pages >= visited_pages
+            elif crawled_pages >= page_num:
+                self.crawl_complete = True
+                self.remove_checkpoint()
+            else:  # 有页面爬取失败,保留断点以便下次从失败处继续
+                self.save_checkpoint(crawled_pages, page_num)
             if not self.config['only_original']:
                 print(u'共爬取' + str(self.got_num) + u'条微博')
             else:
@@ -677,21 +2611,141 @@ class Weibo(object):
             print('Error: ', e)
             traceback.print_exc()
 
+    def write_metrics(self):
+        """将性能指标写入user_id.metrics.json文件,设置了metrics_textfile_dir时
+        同时写入供Prometheus node_exporter读取的weibo_spider_user_id.prom文件"""
+        try:
+            if not self.metrics:
+                return
+            if self.config['metrics']:
+                self.metrics.write_json(self.get_filepath('metrics.json'))
+                print(u'性能指标写入完毕,保存路径:')
+                print(self.get_filepath('metrics.json'))
+            if self.config['metrics_textfile_dir']:
+                file_dir = self.config['metrics_textfile_dir']
+                if not os.path.isdir(file_dir):
+                    os.makedirs(file_dir)
+                self.metrics.write_prometheus(
+                    file_dir + os.sep + 'weibo_spider_%d.prom' % self.user_id)
+        except Exception as e:
+            print('Error: ', e)
+            traceback.print_exc()
+
     def start(self):
         """运行爬虫"""
         try:
+            self.start_download()
             self.get_weibo_info()
+            self.close_writers()
+            self.close_sqlite()
+            self.close_json()
             print(u'信息抓取完毕')
             print('*' * 100)
-            if self.config['pic_download'] == 1:
-                self.download_files('img')
-            if self.config['video_download'] == 1:
-                self.download_files('video')
+            self.finish_download()
+            self.write_metrics()
         except Exception as e:
             print('Error: ', e)
             traceback.print_exc()
 
 
+def get_user_ids(jconfig):
+    """获取要爬取的用户id列表,user_id_list可以是id列表或每行一个id的txt文件路径"""
+    user_ids = jconfig.get('user_id_list') or jconfig.get('user_id')
+    if not isinstance(user_ids, list):
+        if (isinstance(user_ids, str) and not user_ids.isdigit()
+                and os.path.isfile(user_ids)):
+            with open(user_ids, 'r') as f:
+                # 每行第一列为用户id,其余内容(如昵称)和以#开头的行会被忽略
+                user_ids = [
+                    line.split()[0] for line in f
+                    if line.strip() and not line.startswith('#')
+                ]
+        else:
+            user_ids = [user_ids]
+    return [int(user_id) for user_id in user_ids]
+
+
+def crawl_one_user(wb, index, total):
+    """爬取一个用户,异常不会影响其他用户,返回该用户的爬取结果"""
+    print(u'开始爬取第%d/%d个用户: %d' % (index, total, wb.user_id))
+    start_time = time()
+    result = {'user_id': wb.user_id, 'error': ''}
+    try:
+        wb.start()
+    except (Exception, SystemExit) as e:  # 用户级别的错误(如sys.exit)只终止该用户
+        result['error'] = str(e)
+        traceback.print_exc()
+    result['nickname'] = wb.nickname
+    result['got_num'] = wb.got_num
+    result['seconds'] = round(time() - start_time, 1)
+    if result['error']:
+        result['status'] = u'失败'
+    elif wb.crawl_complete:
+        result['status'] = u'完成'
+    else:
+        result['status'] = u'未完成'
+    print(u'第%d/%d个用户%d(%s)爬取%s,共%d条微博,用时%.1f秒' %
+          (index, total, wb.user_id, wb.nickname, result['status'],
+           wb.got_num, result['seconds']))
+    return result
+
+
+def crawl_users(user_ids, config):
+    """批量爬取多个用户,所有用户共享工作线程池、连接池和限速器,返回每个用户的爬取结果"""
+    user_workers = config.get('user_workers') or 1
+    if isinstance(user_workers, bool) or not isinstance(
+            user_workers, int) or user_workers < 1:
+        sys.exit(u'user_workers值应为正整数,代表同时爬取的用户数,请重新输入')
+    weibos = []
+    for user_id in user_ids:
+        if not weibos:
+            weibos.append(Weibo(user_id, config))
+        else:
+            weibos.append(
+                Weibo(user_id,
+                      config,
+                      session=weibos[0].session,
+                      rate_limiter=weibos[0].rate_limiter,
+                      download_rate_limiter=weibos[0].download_rate_limiter,
+                      response_cache=weibos[0].response_cache,
+                      media_store=weibos[0].media_store))
+    results = []
+    try:
+        with ThreadPoolExecutor(max_workers=user_workers) as executor:
+            futures = [
+                executor.submit(crawl_one_user, wb, i + 1, len(weibos))
+                for i, wb in enumerate(weibos)
+            ]
+            results = [future.result() for future in futures]
+    finally:
+        if weibos:
+            weibos[0].session.close()
+    print_summary(results)
+    return results
+
+
+def print_summary(results):
+    """输出批量爬取的汇总信息,并保存到weibo/batch_summary.json"""
+    print('*' * 100)
+    print(u'批量爬取结束: 共%d个用户,完成%d个,未完成%d个,失败%d个' %
+          (len(results), sum(r['status'] == u'完成' for r in results),
+           sum(r['status'] == u'未完成' for r in results),
+           sum(r['status'] == u'失败' for r in results)))
+    for r in results:
+        print(u'%d\t%s\t%s\t%d条微博\t%.1f秒\t%s' %
+              (r['user_id'], r['nickname'], r['status'], r['got_num'],
+               r['seconds'], r['error']))
+    try:
+        file_dir = os.path.split(os.path.realpath(__file__))[0] + os.sep + 'weibo'
+        if not os.path.isdir(file_dir):
+            os.makedirs(file_dir)
+        with open(file_dir + os.sep + 'batch_summary.json', 'w') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    except Exception as e:
+        print('Error: ', e)
+        traceback.print_exc()
+
+
 def main():
     try:
         # 使用实例,输入一个用户id，所有信息都会存储在wb实例中
@@ -701,28 +2755,72 @@ def main():
         except Exception as e:
             print(u'请正确配置 config.json 文件，可从模板文件 config.json.tpl 创建。')
             exit()
-        user_id = int(jconfig.get('user_id'))  # 可以改成任意合法的用户id（爬虫的微博id除外）
+        user_ids = get_user_ids(jconfig)  # 可以改成任意合法的用户id（爬虫的微博id除外）
         config = {
             'only_original': jconfig.get('only_original'),  # 值为0表示爬取全部微博（原创微博+转发微博），值为1表示只爬取原创微博
             'pic_download': jconfig.get('pic_download'),  # 值为0代表不下载微博原始图片,1代表下载微博原始图片
             'video_download': jconfig.get('video_download'),  # 值为0代表不下载微博视频,1代表下载微博视频
             'cookie': jconfig.get('cookie'),  # 抓取时的cookie信息
             'order': jconfig.get('order'),  # 抓取时的顺序，time asc表示时间轴升序，time desc表示时间轴降序
+            'resume': jconfig.get('resume'),  # 值为1表示从上次中断处继续爬取，值为0表示每次从头爬取
+            'incremental': jconfig.get('incremental'),  # 值为1表示只爬取上次运行后发布的新微博并合并到已有结果文件，值为0表示爬取全部微博
+            'since_date': jconfig.get('since_date'),  # 只爬取该日期及之后发布的微博，格式为yyyy-mm-dd，为空表示不限制
+            'until_date': jconfig.get('until_date'),  # 只爬取该日期及之前发布的微博，格式为yyyy-mm-dd，为空表示不限制
+            'start_page': jconfig.get('start_page'),  # 从微博列表的第几页开始爬取，第1页为最新的微博
+            'end_page': jconfig.get('end_page'),  # 爬取到微博列表的第几页，0表示最后一页
+            'pool_connections': jconfig.get('pool_connections'),  # 连接池缓存的主机数
+            'pool_maxsize': jconfig.get('pool_maxsize'),  # 每个主机的最大连接数
+            'keep_alive': jconfig.get('keep_alive'),  # 值为1表示复用HTTP连接(keep-alive)，值为0表示每次请求后关闭连接
+            'engine': jconfig.get('engine'),  # 值为requests表示使用requests发送请求，值为asyncio表示使用基于aiohttp的异步引擎，所有请求都是同一事件循环中的协程
+            'download_workers': jconfig.get('download_workers'),  # 同时下载图片/视频的线程数，值为1表示逐个下载
+            'download_host_limit': jconfig.get('download_host_limit'),  # 同一主机同时下载的最大文件数
+            'download_chunk_size': jconfig.get('download_chunk_size'),  # 下载时每次写入文件的字节数
+            'rate_limit': jconfig.get('rate_limit'),  # 每秒最多请求多少次微博页面，被限制时会自动降速，正常后逐渐恢复
+            'download_rate_limit': jconfig.get('download_rate_limit'),  # 每秒最多请求多少次图片/视频
+            'max_retries': jconfig.get('max_retries'),  # 请求被限制(418/429/5xx)后的最大重试次数
+            'timeout': jconfig.get('timeout'),  # 每次请求的超时秒数
+            'prefetch_pages': jconfig.get('prefetch_pages'),  # 解析当前页时提前获取的微博页数，值为0表示逐页获取
+            'parse_workers': jconfig.get('parse_workers'),  # 同时解析微博页面的线程数
+            'secondary_workers': jconfig.get('secondary_workers'),  # 解析完一页后同时获取该页长微博、组图和视频信息的线程数
+            'user_workers': jconfig.get('user_workers'),  # 批量爬取时同时爬取的用户数
+            'write_sqlite': jconfig.get('write_sqlite'),  # 值为1表示同时将微博写入SQLite数据库，已存在的微博会更新点赞数、转发数和评论数等信息
+            'sqlite_path': jconfig.get('sqlite_path'),  # SQLite数据库文件路径，默认为weibo/weibo.db，所有用户共用
+            'write_pages': jconfig.get('write_pages'),  # 每爬取多少页写入一次csv/txt文件并保存断点
+            'write_json': jconfig.get('write_json'),  # 值为1表示每爬取一页就将微博写入json文件(每行一条微博)，可实时读取
+            'json_compression': jconfig.get('json_compression'),  # json文件的压缩方式，none表示不压缩，gzip或zstd(需安装zstandard)表示压缩
+            'json_flush_pages': jconfig.get('json_flush_pages'),  # 每爬取多少页将json文件的缓冲区写入磁盘
+            'json_fsync': jconfig.get('json_fsync'),  # 值为1表示每次写入磁盘时执行fsync，程序或系统崩溃时也不会丢失已写入的微博
+            'write_columnar': jconfig.get('write_columnar'),  # 值为parquet或arrow表示同时导出类型化的Parquet或Arrow IPC文件(需安装pyarrow)，值为0表示不导出
+            'cache': jconfig.get('cache'),  # 值为1表示将微博页面缓存到磁盘，再次运行时直接读取未过期的缓存
+            'cache_replay': jconfig.get('cache_replay'),  # 值为1表示只从缓存中读取微博页面，不访问网络
+            'cache_dir': jconfig.get('cache_dir'),  # 缓存目录，默认为程序所在目录下的cache文件夹
+            'cache_size': jconfig.get('cache_size'),  # 缓存的最大总大小(MB)，超过时删除最久未使用的页面
+            'cache_ttl': jconfig.get('cache_ttl'),  # 各类页面的缓存有效期(秒)，0表示不缓存，-1表示永不过期
+            'media_store': jconfig.get('media_store'),  # 值为1表示图片/视频保存在按内容去重的共享存储中，各用户文件夹中为硬链接
+            'media_store_dir': jconfig.get('media_store_dir'),  # 共享存储的目录，默认为weibo/.media，需与weibo文件夹在同一磁盘分区
+            'metrics': jconfig.get('metrics'),  # 值为1表示记录各阶段耗时、请求数等性能指标，爬取结束后写入user_id.metrics.json文件
+            'metrics_textfile_dir': jconfig.get('metrics_textfile_dir'),  # 非空时同时将性能指标以Prometheus格式写入该文件夹，供node_exporter的textfile采集器读取
+            'download_existing': jconfig.get('download_existing'),  # 已存在的图片/视频的处理方式，skip表示跳过，verify表示向服务器确认未改变后跳过，overwrite表示重新下载
         }
-        wb = Weibo(user_id, config)  # 调用Weibo类，创建微博实例wb
+        if len(user_ids) > 1:  # 批量爬取多个用户
+            crawl_users(user_ids, config)
+            return
+        wb = Weibo(user_ids[0], config)  # 调用Weibo类，创建微博实例wb
         wb.start()  # 爬取微博信息
         print(u'用户昵称: ' + wb.nickname)
         print(u'全部微博数: ' + str(wb.weibo_num))
         print(u'关注数: ' + str(wb.following))
         print(u'粉丝数: ' + str(wb.followers))
-        if wb.weibo:
-            print(u'最新/置顶 微博为: ' + wb.weibo[0]['overview'])
-            print(u'最新/置顶 微博位置: ' + wb.weibo[0]['publish_place'])
-            print(u'最新/置顶 微博发布时间: ' + wb.weibo[0]['publish_time'])
-            print(u'最新/置顶 微博获得赞数: ' + str(wb.weibo[0]['up_num']))
-            print(u'最新/置顶 微博获得转发数: ' + str(wb.weibo[0]['retweet_num']))
-            print(u'最新/置顶 微博获得评论数: ' + str(wb.weibo[0]['comment_num']))
-            print(u'最新/置顶 微博发布工具: ' + wb.weibo[0]['publish_tool'])
+        if wb.first_weibo:
+            print(u'最新/置顶 微博为: ' + wb.first_weibo['overview'])
+            print(u'最新/置顶 微博位置: ' + wb.first_weibo['publish_place'])
+            print(u'最新/置顶 微博发布时间: ' +
+                  wb.first_weibo.publish_time_text)
+            print(u'最新/置顶 微博获得赞数: ' + str(wb.first_weibo['up_num']))
+            print(u'最新/置顶 微博获得转发数: ' + str(wb.first_weibo['retweet_num']))
+            print(u'最新/置顶 微博获得评论数: ' + str(wb.first_weibo['comment_num']))
+            print(u'最新/置顶 微博发布工具: ' + wb.first_weibo['publish_tool'])
+        wb.session.close()
     except Exception as e:
         print('Error: ', e)
         traceback.print_exc()